@@ -0,0 +1,169 @@
+import os
+import mmap
+import struct
+import json
+import hashlib
+import numpy as np
+
+
+# the corpus and token cache formats shared by Pack_Corpus, Tf-idf_Vectors, HAC_clustering
+# and Multinomial_NB_Classifier, which put this directory on sys.path
+PACK_SUFFIX = '.pack' # IRTM.pack replaces the IRTM/<id>.txt files when present
+PACK_MAGIC = b'IRTMPACK'
+PACK_VERSION = 1
+TOKEN_CACHE = '.token_cache_' # + config hash, kept in the corpus directory
+CACHE_MAGIC = b'TOKCACHE'
+CACHE_VERSION = 1
+
+
+def pack_corpus(directory, pack):
+    # magic, version, document count, count + 1 little endian uint64 offsets into the data,
+    # then the raw bytes of 1.txt, 2.txt, ... back to back
+    count = 0
+    while os.path.exists(os.path.join(directory, str(count + 1) + '.txt')):
+        count += 1
+    offsets = np.zeros(count + 1, dtype='<u8')
+    with open(pack + '.tmp', 'wb') as f:
+        f.write(PACK_MAGIC)
+        f.write(struct.pack('<II', PACK_VERSION, count))
+        f.write(offsets.tobytes()) # filled in once the sizes are known
+        for doc_id in range(1, count + 1):
+            with open(os.path.join(directory, str(doc_id) + '.txt'), 'rb') as doc:
+                raw = doc.read()
+            f.write(raw)
+            offsets[doc_id] = offsets[doc_id - 1] + len(raw)
+        f.seek(len(PACK_MAGIC) + 8)
+        f.write(offsets.tobytes())
+    os.replace(pack + '.tmp', pack)
+    return count, int(offsets[-1])
+
+
+def open_corpus(directory):
+    # <directory>.pack when it has been packed, otherwise the directory of <id>.txt files
+    pack = directory.rstrip('/') + PACK_SUFFIX
+    if not os.path.exists(pack):
+        count = 0
+        while os.path.exists(os.path.join(directory, str(count + 1) + '.txt')):
+            count += 1
+        return {'dir': directory, 'pack': None, 'count': count}
+    with open(pack, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        mtime = os.fstat(f.fileno()).st_mtime_ns
+    if data[:len(PACK_MAGIC)] != PACK_MAGIC:
+        raise ValueError(pack + ' is not a packed corpus')
+    version, count = struct.unpack_from('<II', data, len(PACK_MAGIC))
+    if version != PACK_VERSION:
+        raise ValueError(f'{pack}: unsupported version {version}')
+    head = len(PACK_MAGIC) + 8
+    offsets = np.frombuffer(data, dtype='<u8', count=count + 1, offset=head)
+    cache_dir = directory if os.path.isdir(directory) else (os.path.dirname(pack) or '.')
+    return {'dir': cache_dir, 'pack': data, 'view': memoryview(data), 'offsets': offsets,
+            'base': head + 8 * (count + 1), 'mtime': mtime, 'count': count}
+
+
+def doc_stat(corpus, doc_id):
+    # (mtime, size) of a document, a packed one takes the pack's mtime
+    if corpus['pack'] is None:
+        st = os.stat(os.path.join(corpus['dir'], str(doc_id) + '.txt'))
+        return st.st_mtime_ns, st.st_size
+    if not 1 <= doc_id <= corpus['count']:
+        raise FileNotFoundError(f'document {doc_id} is not in the pack')
+    offsets = corpus['offsets']
+    return corpus['mtime'], int(offsets[doc_id] - offsets[doc_id - 1])
+
+
+def doc_bytes(corpus, doc_id):
+    # raw bytes of a document, a zero copy slice of the mapping for a packed corpus
+    if corpus['pack'] is None:
+        with open(os.path.join(corpus['dir'], str(doc_id) + '.txt'), 'rb') as f:
+            return f.read()
+    if not 1 <= doc_id <= corpus['count']:
+        raise FileNotFoundError(f'document {doc_id} is not in the pack')
+    offsets = corpus['offsets']
+    return corpus['view'][corpus['base'] + int(offsets[doc_id - 1]):corpus['base'] + int(offsets[doc_id])]
+
+
+def iter_docs(corpus):
+    for doc_id in range(1, corpus['count'] + 1):
+        yield doc_id, doc_bytes(corpus, doc_id)
+
+
+def load_token_cache(corpus, config):
+    # stemmed term id sequences of the corpus documents, one cache file per tokenizer config
+    key = hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    cache = {'corpus': corpus, 'file': os.path.join(corpus['dir'], TOKEN_CACHE + key), 'config': config,
+             'terms': [], 'term_id': dict(), 'docs': dict(), 'fresh': None, 'dirty': False}
+    try:
+        with open(cache['file'], 'rb') as f:
+            if f.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+                return cache
+            version, header_len = struct.unpack('<II', f.read(8))
+            if version != CACHE_VERSION:
+                return cache
+            header = json.loads(f.read(header_len).decode('utf-8'))
+            ids = np.frombuffer(f.read(), dtype='<u4')
+    except FileNotFoundError:
+        return cache
+    if header['config'] != config:
+        return cache
+    cache['terms'] = header['terms']
+    cache['term_id'] = {term: n for n, term in enumerate(header['terms'])}
+    for name, (mtime, size, digest, start, length) in header['docs'].items():
+        cache['docs'][name] = [mtime, size, digest, ids[start:start + length]]
+    return cache
+
+
+def cached_tokens(cache, doc_id, tokenize_text):
+    # a document is reused while mtime and size match, or when its content hash still does
+    name = str(doc_id) + '.txt'
+    mtime, size = doc_stat(cache['corpus'], doc_id)
+    entry = cache['docs'].get(name)
+    if entry and entry[0] == mtime and entry[1] == size:
+        return [cache['terms'][i] for i in entry[3]]
+    raw = doc_bytes(cache['corpus'], doc_id)
+    digest = hashlib.sha1(raw).hexdigest()
+    if entry and entry[2] == digest:
+        entry[0] = mtime
+        entry[1] = size
+        cache['dirty'] = True
+        return [cache['terms'][i] for i in entry[3]]
+    words = tokenize_text(str(raw, 'utf-8'))
+    store_tokens(cache, name, mtime, size, digest, words)
+    if cache['fresh'] is not None:
+        # worker processes hand their new entries back to the parent, which owns the file
+        cache['fresh'][name] = (mtime, size, digest, words)
+    return words
+
+
+def store_tokens(cache, name, mtime, size, digest, words):
+    ids = []
+    for word in words:
+        if word not in cache['term_id']:
+            cache['term_id'][word] = len(cache['terms'])
+            cache['terms'].append(word)
+        ids.append(cache['term_id'][word])
+    cache['docs'][name] = [mtime, size, digest, np.array(ids, dtype='<u4')]
+    cache['dirty'] = True
+
+
+def save_token_cache(cache):
+    # magic, version, JSON header (config, term table, per document stat, hash and slice),
+    # then every document's term ids as little endian uint32
+    if not cache['dirty']:
+        return
+    docs = dict()
+    chunks = []
+    start = 0
+    for name, (mtime, size, digest, ids) in cache['docs'].items():
+        docs[name] = [mtime, size, digest, start, len(ids)]
+        chunks.append(np.asarray(ids, dtype='<u4'))
+        start += len(ids)
+    header = json.dumps({'config': cache['config'], 'terms': cache['terms'], 'docs': docs}).encode('utf-8')
+    with open(cache['file'] + '.tmp', 'wb') as f:
+        f.write(CACHE_MAGIC)
+        f.write(struct.pack('<II', CACHE_VERSION, len(header)))
+        f.write(header)
+        for ids in chunks:
+            f.write(ids.tobytes())
+    os.replace(cache['file'] + '.tmp', cache['file'])
+    cache['dirty'] = False
@@ -0,0 +1,127 @@
+import os
+import hashlib
+import mmap
+import struct
+import numpy as np
+from scipy import sparse
+
+
+# vector formats and feature hashing shared by Tf-idf_Vectors, HAC_clustering and
+# Multinomial_NB_Classifier
+QUANT_MAGIC = b'QVECTORS'
+QUANT_VERSION = 2 # 2 stores the document id of every row
+QUANT_MODES = ['float16', 'int8']
+
+
+def vector_ids(path):
+    # ids of the documents that have a <path>/<id>.txt; an exported index leaves out the
+    # removed documents, so the ids can have gaps
+    return sorted(int(name[:-4]) for name in os.listdir(path) if name.endswith('.txt') and name[:-4].isdigit())
+
+
+def read_vectors(path):
+    # tf-idf vectors written by Tf-idf_Vectors main() or export: the document ids and one
+    # L2 normalized CSR row per document, row n is document doc_ids[n]
+    doc_ids = vector_ids(path)
+    indptr = [0]
+    indices = []
+    data = []
+    for doc_id in doc_ids:
+        with open(os.path.join(path, str(doc_id) + '.txt'), 'r') as f:
+            for line in f.readlines()[2:]:
+                t_index, tf_idf = line.split()
+                indices.append(int(t_index) - 1) # t_index starts from one
+                data.append(float(tf_idf))
+        indptr.append(len(indices))
+    num_term = max(indices) + 1 if indices else 0
+    X = sparse.csr_matrix((np.array(data), np.array(indices, dtype=np.int32), np.array(indptr)), shape=(len(doc_ids), num_term))
+    norm = np.sqrt(np.asarray(X.multiply(X).sum(axis=1)).ravel())
+    norm[norm == 0] = 1
+    return np.array(doc_ids, dtype=np.int64), sparse.csr_matrix(sparse.diags(1 / norm) @ X)
+
+
+def quantize_vectors(X, mode):
+    # float16 weights, or int8 with one float32 scale per row (max |weight| maps to 127)
+    X = sparse.csr_matrix(X)
+    num_doc = X.shape[0]
+    if mode == 'float16':
+        return {'mode': mode, 'shape': X.shape, 'indptr': X.indptr.astype(np.int64), 'indices': X.indices.astype(np.uint32),
+                'scale': np.ones(num_doc, dtype=np.float32), 'data': X.data.astype(np.float16)}
+    row_max = np.zeros(num_doc)
+    for n in range(num_doc):
+        if X.indptr[n + 1] > X.indptr[n]:
+            row_max[n] = np.abs(X.data[X.indptr[n]:X.indptr[n + 1]]).max()
+    scale = (row_max / 127).astype(np.float32)
+    scale[scale == 0] = 1
+    rows = np.repeat(np.arange(num_doc), np.diff(X.indptr))
+    data = np.clip(np.rint(X.data / scale[rows]), -127, 127).astype(np.int8)
+    return {'mode': mode, 'shape': X.shape, 'indptr': X.indptr.astype(np.int64), 'indices': X.indices.astype(np.uint32),
+            'scale': scale, 'data': data}
+
+
+def save_quantized(name, q, doc_ids):
+    # magic, version, mode (1 float16, 2 int8), docs, terms, then int64 doc ids, int64 indptr,
+    # uint32 indices, float32 row scales and the weights, every array 8-byte aligned
+    with open(name + '.tmp', 'wb') as f:
+        f.write(QUANT_MAGIC)
+        f.write(struct.pack('<IIII', QUANT_VERSION, QUANT_MODES.index(q['mode']) + 1, q['shape'][0], q['shape'][1]))
+        f.write(struct.pack('<Q', len(q['data'])))
+        f.write(np.asarray(doc_ids, dtype='<i8').tobytes())
+        for key in ('indptr', 'indices', 'scale', 'data'):
+            f.write(q[key].tobytes())
+            f.write(b'\0' * (-f.tell() % 8))
+    os.replace(name + '.tmp', name)
+
+
+def load_quantized(name):
+    # the document ids and the dequantized float32 CSR rows, the file is mapped rather than read
+    with open(name, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if data[:len(QUANT_MAGIC)] != QUANT_MAGIC:
+        raise ValueError(name + ' is not a quantized vector file')
+    version, mode, num_doc, num_term = struct.unpack_from('<IIII', data, len(QUANT_MAGIC))
+    nnz, = struct.unpack_from('<Q', data, len(QUANT_MAGIC) + 16)
+    if version not in (1, QUANT_VERSION):
+        raise ValueError(f'{name}: unsupported version {version}')
+    offset = len(QUANT_MAGIC) + 24
+    if version == 1:
+        doc_ids = np.arange(1, num_doc + 1) # written from vector/1.txt ... without gaps
+    else:
+        doc_ids = np.frombuffer(data, dtype='<i8', count=num_doc, offset=offset)
+        offset += doc_ids.nbytes
+    arrays = []
+    for dtype, count in [('<i8', num_doc + 1), ('<u4', nnz), ('<f4', num_doc), ('<f2' if mode == 1 else 'i1', nnz)]:
+        arrays.append(np.frombuffer(data, dtype=dtype, count=count, offset=offset))
+        offset += arrays[-1].nbytes + (-(offset + arrays[-1].nbytes) % 8)
+    indptr, indices, scale, weights = arrays
+    return doc_ids, dequantize({'mode': QUANT_MODES[mode - 1], 'shape': (num_doc, num_term), 'indptr': indptr,
+                                'indices': indices, 'scale': scale, 'data': weights})
+
+
+def dequantize(q):
+    rows = np.repeat(np.arange(q['shape'][0]), np.diff(q['indptr']))
+    values = q['data'].astype(np.float32) * q['scale'][rows]
+    return sparse.csr_matrix((values, q['indices'].astype(np.int32), q['indptr']), shape=q['shape'])
+
+
+def hash_term(term, bits):
+    # stable across processes and runs (unlike hash()): the low bits pick the column,
+    # the top bit the sign
+    h = int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little')
+    return h & ((1 << bits) - 1), -1 if h >> 63 else 1
+
+
+def hash_counts(docs, bits, signed=True):
+    # [docs x 2^bits] term counts without any vocabulary, colliding terms share a column
+    indptr = [0]
+    indices = []
+    data = []
+    for words in docs:
+        for word in words:
+            col, sign = hash_term(word, bits)
+            indices.append(col)
+            data.append(sign if signed else 1)
+        indptr.append(len(indices))
+    X = sparse.csr_matrix((np.array(data, dtype=float), indices, indptr), shape=(len(docs), 1 << bits))
+    X.sum_duplicates()
+    return X
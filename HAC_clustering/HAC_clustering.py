@@ -1,9 +1,23 @@
 import requests
 import re
+import os
 import sys
 import math
+import random
+import time
+import pickle
+import hashlib
+import inspect
+import numpy as np
 from scipy import spatial
+from scipy import sparse
+from scipy.cluster import hierarchy
+from multiprocessing import Pool
+from multiprocessing import shared_memory
 from nltk.corpus import stopwords
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Common'))
+from corpus_io import open_corpus, load_token_cache, cached_tokens, save_token_cache
+from vectors import read_vectors, load_quantized
 # for Porter's stemmer algorithm
 class PorterStemmer:
 
@@ -352,6 +366,22 @@ def heapify(data, root, length, mapping):
 
 
 DOC_NUM = 1095
+LINKAGE = 'complete' # 'single', 'complete', 'centroid' or 'group_average'
+VECTOR_PATH = '../Tf-idf_Vectors/vector/'
+LSI_FILE = '../Tf-idf_Vectors/lsi.npz' # written by Tf-idf_Vectors.py lsi
+QUANT_FILE = '../Tf-idf_Vectors/vector.q' # written by Tf-idf_Vectors.py quantize
+SIM16_FILE = 'sim_f16.npy' # condensed similarity upper triangle in float16
+CHECKPOINT = 'hac_checkpoint'
+CHECKPOINT_INTERVAL = 60 # seconds between checkpoints at least
+CHECKPOINT_RATIO = 0.05 # at most this share of the merge time goes to checkpoints
+TOKEN_SPLIT = ' |\.|\'|\r|\n|\,|\?|\`|\(|\)|\-|\@|\"|\:|\_|\%|\#|\;|\/|\*|\$|\&|\!'
+MIN_TOKEN_LEN = 2
+try:
+    # changes whenever PorterStemmer is edited, so cached stems are never reused across versions
+    STEMMER_ID = hashlib.sha1(inspect.getsource(PorterStemmer).encode()).hexdigest()[:16]
+except (OSError, TypeError):
+    STEMMER_ID = 'porter-1' # no source to hash (.pyc only, exec'd code), a fixed id keys the cache instead
+CORPUS = 'IRTM'
 
 def swap(a,b):
     if a > b:
@@ -361,69 +391,64 @@ def swap(a,b):
     return a, b
 
 
-def main():
+def main(resume=False):
+    if resume and os.path.exists(CHECKPOINT):
+        hac(None, None, None, [20, 13, 8], checkpoint=CHECKPOINT, resume=True)
+        return
     stop_words = set(stopwords.words('english'))
     p = PorterStemmer()
     count = 1
-    fileName = str(count) + '.txt'
     word_list = []
     output = []
     _id = 0
     term_in_art = []
-    while True:
+    corpus = open_corpus(CORPUS)
+    cache = load_token_cache(corpus, tokenizer_settings(stop_words))
+    while count <= corpus['count']:
         try:
-            with open ('IRTM/' + fileName, 'r') as f :
-                df_num = False
-                temp = [] # record term id 
-                data = re.split(' |\.|\'|\r|\n|\,|\?|\`|\(|\)|\-|\@|\"|\:|\_|\%|\#|\;|\/|\*|\$|\&|\!', f.read())
-                for token in data :
-                    token = token.lower()
-                    if token is '' or len(token) < 2:
-                        continue
-                    if token in stop_words:
-                        continue
-                    if re.search(r'\d', token): # if token has number in it 
-                        continue
-                    stemmed_word = p.stem(token, 0,len(token)-1)
-                    if stemmed_word not in word_list:
-                        word_list.append(stemmed_word)
-                        output.append({'term': stemmed_word, 'df': 1 , 'all-tf':[{'id':count, 'tf':1}], 'id': _id})
-                        temp.append(_id)
-                        _id += 1
+            words = cached_tokens(cache, count, lambda text: tokenize(text, stop_words, p))
+            df_num = False
+            temp = [] # record term id 
+            for stemmed_word in words :
+                if stemmed_word not in word_list:
+                    word_list.append(stemmed_word)
+                    output.append({'term': stemmed_word, 'df': 1 , 'all-tf':[{'id':count, 'tf':1}], 'id': _id})
+                    temp.append(_id)
+                    _id += 1
+                    df_num = True
+                else:
+                    index = word_list.index(stemmed_word)
+                    flag = 0
+                    for data in output[index]['all-tf']:
+                        if data['id'] == count:
+                            data['tf'] +=1
+                            flag = 1
+                        break
+                    if not flag:
+                        output[index]['all-tf'].append({'id': count, 'tf':1})
+                    temp.append(output[index]['id'])
+                    # if output[index]['word'] != stemmed_word:
+                    #     print('error')
+                    #     break
+                    if not df_num:
+                        output[index]['df'] += 1
                         df_num = True
-                    else:
-                        index = word_list.index(stemmed_word)
-                        flag = 0
-                        for data in output[index]['all-tf']:
-                            if data['id'] == count:
-                                data['tf'] +=1
-                                flag = 1
-                            break
-                        if not flag:
-                            output[index]['all-tf'].append({'id': count, 'tf':1})
-                        temp.append(output[index]['id'])
-                        # if output[index]['word'] != stemmed_word:
-                        #     print('error')
-                        #     break
-                        if not df_num:
-                            output[index]['df'] += 1
-                            df_num = True
-                term_in_art.append(list(set(temp)))
+            term_in_art.append(list(set(temp)))
             print('finished' + ' '+str(count) + ' ' + 'document' )
             count += 1
-            fileName = str(count) + '.txt'
         except Exception as e:
             #print(e)
             print('finish')
             break
+    save_token_cache(cache)
 
     #2 
-    num_doc = 1095
+    num_doc = len(term_in_art)
     count = 1
     fileName = str(count) + '.txt'
-    all_doc = [[] for i in range(num_doc)] 
+    all_doc = [dict() for i in range(num_doc)]
     for art in term_in_art :
-        doc = [0 for i in range(len(output))]
+        doc = dict() # sparse vector, term id -> tf-idf
         try:  
             for term_id in art:
                 tf = None
@@ -434,7 +459,7 @@ def main():
                         break
                 tf_idf = math.log(num_doc / df, 10) * tf
                 doc [term_id] = tf_idf
-            all_doc[count-1] = doc 
+            all_doc[count-1] = normalize(doc)
             print('finished transform to word vector: ' + ' '+str(count) + ' ' + 'document' )
             count += 1
             fileName = str(count) + '.txt'
@@ -444,74 +469,58 @@ def main():
             break
     
     # calculate similarity
-    avail_clus = [1 for i in range(0, DOC_NUM)]
-    priority = dict()
-    clusters = dict()
-    # with open ('temp_sim', 'w') as f:
-    # for i in range(0, DOC_NUM):
-    #     temp_dict = dict()
-    #     for j in range(i+1, DOC_NUM):
-    #         if i != j:
-    #             sim_info = dict()
-    #             sim_info = {j: cos_similarity(all_doc[i], all_doc[j])}
-    #             temp_dict.update(sim_info)
-    #     #         f.write(str(cos_similarity(all_doc[i], all_doc[j])))
-    #     #         f.write(' ')
-    #     # f.write('\n')        
-    #     clusters[i] = temp_dict
-    #     max_list =  sorted(temp_dict.items(), key=lambda d: d[1],reverse=True)
-    #     temp = list()
-    #     for key, val in max_list:
-    #         temp.append(key)
-    #     print(i)
-    #     priority[i] = temp
-    all_prio = list()
-    mapping = dict()
-
-    with open('temp_sim', 'r') as f:
-        front_ind = 0
-        for i in f.readlines():
-            temp = dict()
-            index = front_ind+1
-            for k in i.split(' '):
-                try:
-                    if k != '\n':
-                        temp[index] = float(k)
-                except :
-                    continue
-                index += 1
-            clusters[front_ind] = temp
-            max_list =  sorted(temp.items(), key=lambda d: d[1],reverse=True)
-            temp_data = list()
-            for key, val in max_list:
-                temp_data.append(key)
-            priority[front_ind] = temp_data
-            front_ind += 1   
-
-    
-    merge_list = dict()
-    central = dict()
-    doc_len = dict()
-
-
-    for i in range(0, DOC_NUM):
-        merge_list[i] = [i]
-        central[i] = all_doc[i]
-        doc_len[i] = 1
-        
+    if os.path.exists('temp_sim'):
+        clusters, priority = read_similarity('temp_sim')
+    else:
+        clusters, priority = parallel_similarity(all_doc, os.cpu_count() or 1)
+
+    hac(all_doc, clusters, priority, [20, 13, 8], checkpoint=CHECKPOINT)
+
+
+def hac(all_doc, clusters, priority, result_sizes, write=True, checkpoint=None, resume=False, partitions=None, doc_ids=None):
+    # merge until min(result_sizes) clusters are left, writing result_N.txt on the way
+    # (or keeping a copy in partitions); doc_ids maps rows to document ids, rows are
+    # documents 1..n without it
+    if resume:
+        state = load_checkpoint(checkpoint)
+        doc_ids = state.get('doc_ids')
+        num_doc = state['num_doc']
+        avail_clus = state['avail_clus']
+        merge_list = state['merge_list']
+        clusters = state['clusters']
+        priority = state['priority']
+        sums = state['sums']
+        sq_norms = state['sq_norms']
+        sizes = state['sizes']
+        print(f'resumed from {checkpoint} with {len(merge_list)} clusters')
+    else:
+        num_doc = len(all_doc)
+        avail_clus = [1 for i in range(0, num_doc)]
+        merge_list = dict()
+        # running sparse sum vector, squared norm of the sum and size per cluster
+        sums = dict()
+        sq_norms = dict()
+        sizes = dict()
+
+
+        for i in range(0, num_doc):
+            merge_list[i] = [i]
+            sums[i] = dict(all_doc[i])
+            sq_norms[i] = sparse_dot(all_doc[i], all_doc[i])
+            sizes[i] = 1
+
+    # next checkpoint is pushed back so that saving stays a bounded share of merge time
+    last_save = time.time()
+    next_wait = CHECKPOINT_INTERVAL
     
-    while(True):
+    while(len(merge_list) > min(result_sizes)):
         ### heap
         ####
         print(len(merge_list))
         i, j = get_highest_sim(priority, clusters, avail_clus)
         print(i, j)
-        #if centroid method
-        # doc_com = doc_len[i] + doc_len[j]
-        # temp = merge( multiply(central[i], doc_len[i]) , multiply(central[j], doc_len[j]) )
-        # central[i] = multiply( temp, 1/doc_com )
-        # doc_len[i] = doc_com
-        ###########
+        if LINKAGE == 'centroid' or LINKAGE == 'group_average':
+            merge_sum(i, j, sums, sq_norms, sizes)
         for val in merge_list[j]:
             merge_list[i].append(val)
 
@@ -519,39 +528,325 @@ def main():
         avail_clus[j] = 0
         priority[i] = []
         priority[j] = []
-        for num in range(0, DOC_NUM):
+        for num in range(0, num_doc):
             if avail_clus[num] ==1  and num != i:
                 if num < j:
                     priority[num].remove(j)
                 if num < i:    
                     priority[num].remove(i)
-                    clusters[num][i] = complete_link(num, i, j, clusters)
-                    # clusters[num][i] = centroid_cluster(num, i, central)
+                    clusters[num][i] = linkage_sim(num, i, j, clusters, sums, sq_norms, sizes)
                     index = insert_new(num, priority[num], clusters,  clusters[num][i])
                     priority[num].insert(index, i)
                 else:
-                    # clusters[i][num] = centroid_cluster(num, i, central)
-                    clusters[i][num] = complete_link(num, i, j, clusters)
+                    clusters[i][num] = linkage_sim(num, i, j, clusters, sums, sq_norms, sizes)
                     index = insert_new(i, priority[i], clusters,  clusters[i][num])
                     priority[i].insert(index, num)
                 
 
 
-        if len(merge_list) == 20 or len(merge_list) == 13 or len(merge_list) == 8:
-            name = 'result_' + str(len(merge_list))+ '.txt'
-            with open (name, 'w') as f:
-                for key, val in merge_list.items():
-                    val.sort()
-                    for _id in val:
-                        f.write(str(_id+1))
-                        f.write('\n')
-                    f.write('\n')
-                    
-            if len(merge_list)==8:
-                break
+        if write and len(merge_list) in result_sizes:
+            write_result('result_' + str(len(merge_list))+ '.txt', list(merge_list.values()), doc_ids)
+        if partitions is not None and len(merge_list) in result_sizes:
+            partitions[len(merge_list)] = [list(val) for val in merge_list.values()]
+
+        if checkpoint and time.time() - last_save >= next_wait:
+            start = time.time()
+            save_checkpoint(checkpoint, {'doc_ids': doc_ids, 'num_doc': num_doc, 'avail_clus': avail_clus, 'merge_list': merge_list,
+                                         'clusters': clusters, 'priority': priority, 'sums': sums,
+                                         'sq_norms': sq_norms, 'sizes': sizes})
+            last_save = time.time()
+            next_wait = max(CHECKPOINT_INTERVAL, (last_save - start) / CHECKPOINT_RATIO)
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return merge_list
+
+
+def save_checkpoint(name, state):
+    # write to a temporary file first so a crash while saving keeps the previous checkpoint
+    with open(name + '.tmp', 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(name + '.tmp', name)
+
+
+def load_checkpoint(name):
+    with open(name, 'rb') as f:
+        return pickle.load(f)
+
+
+def write_result(name, groups, doc_ids=None):
+    with open (name, 'w') as f:
+        for val in groups:
+            val.sort()
+            for _id in val:
+                f.write(str(_id+1) if doc_ids is None else str(doc_ids[_id]))
+                f.write('\n')
+            f.write('\n')
+
+
+def parallel_similarity(all_doc, workers):
+    # the normalized CSR matrix and the condensed upper triangle live in shared memory,
+    # each worker fills its block of rows in place and returns nothing
+    num_doc = len(all_doc)
+    X = to_csr(all_doc)
+    size = num_doc * (num_doc - 1) // 2
+    blocks = [(X.data, 'float64'), (X.indices, 'int32'), (X.indptr, 'int32')]
+    shms = []
+    try:
+        for arr, dtype in blocks:
+            shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+            np.ndarray(arr.shape, dtype=dtype, buffer=shm.buf)[:] = arr
+            shms.append(shm)
+        out = shared_memory.SharedMemory(create=True, size=max(size * 8, 1))
+        shms.append(out)
+        meta = [(shm.name, arr.shape, dtype) for shm, (arr, dtype) in zip(shms, blocks)]
+        jobs = row_blocks(num_doc, workers * 4)
+        with Pool(workers, initializer=init_sim_worker, initargs=(meta, X.shape, out.name, size)) as pool:
+            pool.map(sim_block, jobs)
+        condensed = np.ndarray((size,), dtype='float64', buffer=out.buf).copy()
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+    return condensed_to_priority(condensed, num_doc)
+
+
+def row_blocks(num_doc, num_block):
+    # row i owns num_doc-1-i pairs, cut the rows so every block gets about the same number
+    total = num_doc * (num_doc - 1) // 2
+    blocks = []
+    start = 0
+    done = 0
+    for b in range(1, num_block + 1):
+        end = start
+        while end < num_doc and done < total * b / num_block:
+            done += num_doc - 1 - end
+            end += 1
+        if end > start:
+            blocks.append((start, end))
+        start = end
+    return blocks
+
+
+_shared = dict()
+
+def init_sim_worker(meta, shape, out_name, size):
+    arrays = []
+    for name, arr_shape, dtype in meta:
+        shm = shared_memory.SharedMemory(name=name)
+        _shared[name] = shm
+        arrays.append(np.ndarray(arr_shape, dtype=dtype, buffer=shm.buf))
+    _shared['X'] = sparse.csr_matrix(tuple(arrays), shape=shape)
+    out = shared_memory.SharedMemory(name=out_name)
+    _shared[out_name] = out
+    _shared['out'] = np.ndarray((size,), dtype='float64', buffer=out.buf)
+
+
+def sim_block(rows):
+    start, end = rows
+    X = _shared['X']
+    out = _shared['out']
+    num_doc = X.shape[0]
+    block = (X[start:end] @ X[start:].T).toarray()
+    for i in range(start, end):
+        offset = i * num_doc - i * (i + 1) // 2
+        out[offset:offset + num_doc - 1 - i] = block[i - start, i - start + 1:]
+
+
+def condensed_to_priority(condensed, num_doc):
+    clusters = dict()
+    priority = dict()
+    for i in range(0, num_doc):
+        offset = i * num_doc - i * (i + 1) // 2
+        row = condensed[offset:offset + num_doc - 1 - i]
+        clusters[i] = dict(zip(range(i+1, num_doc), row.tolist()))
+        priority[i] = (np.argsort(-row, kind='stable') + i + 1).tolist()
+    return clusters, priority
+
+
+def to_csr(all_doc):
+    indptr = [0]
+    indices = []
+    data = []
+    for doc in all_doc:
+        for term, weight in doc.items():
+            indices.append(term)
+            data.append(weight)
+        indptr.append(len(indices))
+    num_term = max(indices) + 1 if indices else 0
+    return sparse.csr_matrix((np.array(data, dtype='float64'), np.array(indices, dtype='int32'), np.array(indptr, dtype='int32')), shape=(len(all_doc), num_term))
+
+
+def read_similarity(name):
+    clusters = dict()
+    priority = dict()
+    with open(name, 'r') as f:
+        front_ind = 0
+        for i in f.readlines():
+            temp = dict()
+            index = front_ind+1
+            for k in i.split(' '):
+                try:
+                    if k != '\n':
+                        temp[index] = float(k)
+                except :
+                    continue
+                index += 1
+            clusters[front_ind] = temp
+            max_list =  sorted(temp.items(), key=lambda d: d[1],reverse=True)
+            temp_data = list()
+            for key, val in max_list:
+                temp_data.append(key)
+            priority[front_ind] = temp_data
+            front_ind += 1   
+    return clusters, priority
+
+
+def read_lsi(name):
+    # the dense float32 lsi document vectors as unit length dicts, so every linkage works
+    # on them unchanged, plus the condensed cosine upper triangle from one dense product
+    with np.load(name) as data:
+        D = data['docs'].astype('float64')
+        doc_ids = data['doc_ids'] if 'doc_ids' in data.files else np.arange(1, len(D) + 1)
+    norm = np.linalg.norm(D, axis=1)
+    norm[norm == 0] = 1
+    D = D / norm[:, None]
+    all_doc = [dict(enumerate(row.tolist())) for row in D]
+    num_doc = len(D)
+    condensed = (D @ D.T)[np.triu_indices(num_doc, 1)]
+    return doc_ids, all_doc, condensed
+
+
+def lsi_main():
+    doc_ids, all_doc, condensed = read_lsi(LSI_FILE)
+    clusters, priority = condensed_to_priority(condensed, len(all_doc))
+    hac(all_doc, clusters, priority, [20, 13, 8], doc_ids=doc_ids)
+
+
+def sparse_rows(X):
+    # CSR rows as the unit length dicts hac() works on
+    return [normalize(dict(zip(X.indices[X.indptr[n]:X.indptr[n + 1]].tolist(), X.data[X.indptr[n]:X.indptr[n + 1]].tolist())))
+            for n in range(X.shape[0])]
+
+
+def condensed_similarity(all_doc):
+    X = to_csr(all_doc)
+    return (X @ X.T).toarray()[np.triu_indices(len(all_doc), 1)]
+
+
+def save_similarity16(name, condensed):
+    np.save(name, condensed.astype('<f2'))
+
+
+def read_similarity16(name):
+    return np.load(name, mmap_mode='r').astype('float64')
+
+
+def quantized_main():
+    # cluster the quantized vectors of vector.q with a float16 similarity matrix
+    doc_ids, X = load_quantized(QUANT_FILE)
+    all_doc = sparse_rows(X)
+    save_similarity16(SIM16_FILE, condensed_similarity(all_doc))
+    clusters, priority = condensed_to_priority(read_similarity16(SIM16_FILE), len(all_doc))
+    hac(all_doc, clusters, priority, [20, 13, 8], doc_ids=doc_ids)
+
+
+def adjusted_rand(groups_a, groups_b, num_doc):
+    # agreement of two partitions, 1 for identical and about 0 for chance
+    label_a = np.zeros(num_doc, dtype=np.int64)
+    label_b = np.zeros(num_doc, dtype=np.int64)
+    for n, val in enumerate(groups_a):
+        label_a[val] = n
+    for n, val in enumerate(groups_b):
+        label_b[val] = n
+    table = np.zeros((len(groups_a), len(groups_b)))
+    np.add.at(table, (label_a, label_b), 1)
+    pairs = lambda x: (x * (x - 1) / 2).sum()
+    index = pairs(table)
+    rows = pairs(table.sum(axis=1))
+    cols = pairs(table.sum(axis=0))
+    expected = rows * cols / pairs(np.array([num_doc]))
+    top = (rows + cols) / 2
+    return 1.0 if top == expected else (index - expected) / (top - expected)
+
+
+def quantize_report(result_sizes=(20, 13, 8)):
+    # HAC partitions on full precision vectors against vector.q with a float16 similarity matrix
+    doc_ids, X = read_vectors(VECTOR_PATH)
+    quant_ids, Xq = load_quantized(QUANT_FILE)
+    if not np.array_equal(doc_ids, quant_ids):
+        raise ValueError(f'{QUANT_FILE} holds other documents than {VECTOR_PATH}: quantize again')
+    full_doc = sparse_rows(X)
+    quant_doc = sparse_rows(Xq)
+    full_sim = condensed_similarity(full_doc)
+    quant_sim = condensed_similarity(quant_doc).astype('<f2').astype('float64')
+    result = []
+    for all_doc, condensed in [(full_doc, full_sim), (quant_doc, quant_sim)]:
+        partitions = dict()
+        clusters, priority = condensed_to_priority(condensed, len(all_doc))
+        hac(all_doc, clusters, priority, list(result_sizes), write=False, partitions=partitions)
+        result.append(partitions)
+    err = np.abs(quant_sim - full_sim)
+    print(f'similarity error mean {err.mean():.2e} max {err.max():.2e}')
+    for k in result_sizes:
+        print(f'{k} clusters: adjusted rand index {adjusted_rand(result[0][k], result[1][k], len(full_doc)):.4f}')
+
+
+def buckshot(all_doc, k, passes=0, seed=None):
+    # HAC on a random sqrt(kn) sample gives the seeds, every document then goes to
+    # the nearest seed centroid, optionally refined with a few k-means passes
+    num_doc = len(all_doc)
+    rng = random.Random(seed)
+    sample = rng.sample(range(num_doc), min(num_doc, max(k, int(math.sqrt(k * num_doc)))))
+    X = to_csr(all_doc)
+    sample_labels = sample_hac(X[sample], k)
+    labels = assign_nearest(X, centroids(X, np.array(sample), sample_labels, k))
+    for n in range(passes):
+        new_labels = assign_nearest(X, centroids(X, np.arange(num_doc), labels, k))
+        if np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+    groups = [[] for i in range(k)]
+    for doc_id, label in enumerate(labels.tolist()):
+        groups[label].append(doc_id)
+    return [val for val in groups if val]
+
+
+def sample_hac(X, k):
+    # the sample's dendrogram in O(s^2 log s) with scipy instead of hac(), whose list updates
+    # are O(s^3), cut at k clusters. Distances are 1 - cos, euclidean between the unit
+    # vectors for centroid linkage; group average becomes scipy's average linkage
+    num = X.shape[0]
+    if num < 2:
+        return np.zeros(num, dtype=np.int64)
+    dist = np.clip(1 - (X @ X.T).toarray()[np.triu_indices(num, 1)], 0, None)
+    method = {'single': 'single', 'centroid': 'centroid', 'group_average': 'average'}.get(LINKAGE, 'complete')
+    if method == 'centroid':
+        dist = np.sqrt(2 * dist)
+    Z = hierarchy.linkage(dist, method=method)
+    return hierarchy.fcluster(Z, k, criterion='maxclust') - 1
+
+
+def centroids(X, doc_ids, labels, k):
+    # unit length centroid per label from one sparse product, empty labels stay zero
+    member = sparse.csr_matrix((np.ones(len(doc_ids)), (labels, doc_ids)), shape=(k, X.shape[0]))
+    C = (member @ X).toarray()
+    norm = np.linalg.norm(C, axis=1)
+    norm[norm == 0] = 1
+    return C / norm[:, None]
+
+
+def assign_nearest(X, C):
+    # every document against every centroid in one CSR @ dense product
+    return np.asarray(X @ C.T).argmax(axis=1)
+
+
+def buckshot_main(k, passes):
+    doc_ids, X = read_vectors(VECTOR_PATH)
+    groups = buckshot(sparse_rows(X), k, passes)
+    write_result('result_' + str(k) + '.txt', groups, doc_ids)
 
 def insert_new(i, pri, clu, val):
-    index = 0
+    index = len(pri)
     # print(pri)
     # print(clu)
     for k in range(0, len(pri)):
@@ -573,27 +868,69 @@ def complete_link(i, j ,k, clusters):
     return min(clusters[k1][k2], clusters[k3][k4])
 
 
-def centroid_cluster(i, j ,central):
-    return cos_similarity(central[i], central[j])
+def centroid_cluster(i, j, sums, sizes):
+    # dot product of the two centroids, taken on the sum vectors
+    return sparse_dot(sums[i], sums[j]) / (sizes[i] * sizes[j])
+
+
+def group_average(i, j, sums, sq_norms, sizes):
+    # average similarity over all pairs of the merged cluster (excluding self pairs),
+    # |s_i + s_j|^2 = |s_i|^2 + |s_j|^2 + 2 s_i.s_j with unit length documents
+    n = sizes[i] + sizes[j]
+    sq_norm = sq_norms[i] + sq_norms[j] + 2 * sparse_dot(sums[i], sums[j])
+    return (sq_norm - n) / (n * (n - 1))
+
+
+def linkage_sim(i, j, k, clusters, sums, sq_norms, sizes):
+    # similarity between cluster i and cluster j, which has just absorbed k
+    if LINKAGE == 'single':
+        return single_link(i, j, k, clusters)
+    if LINKAGE == 'centroid':
+        return centroid_cluster(i, j, sums, sizes)
+    if LINKAGE == 'group_average':
+        return group_average(i, j, sums, sq_norms, sizes)
+    return complete_link(i, j, k, clusters)
 
 
-def multiply(cen_list, y):
-    for i in range(len(cen_list)):
-        cen_list[i] = cen_list[i] * y
-    return cen_list  
+def merge_sum(i, j, sums, sq_norms, sizes):
+    # cluster i absorbs cluster j
+    sq_norms[i] = sq_norms[i] + sq_norms.pop(j) + 2 * sparse_dot(sums[i], sums[j])
+    sums[i] = sparse_add(sums[i], sums.pop(j))
+    sizes[i] += sizes.pop(j)
 
 
-def merge(a, b):
-    for i in range(len(a)):
-        a[i] += b[i]
+def sparse_dot(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    result = 0
+    for term, weight in a.items():
+        val = b.get(term)
+        if val is not None:
+            result += weight * val
+    return result
+
+
+def sparse_add(a, b):
+    # add the shorter vector into the longer one in place
+    if len(a) < len(b):
+        a, b = b, a
+    for term, weight in b.items():
+        a[term] = a.get(term, 0) + weight
     return a
 
+
+def normalize(vec):
+    length = math.sqrt(sparse_dot(vec, vec))
+    if length == 0:
+        return vec
+    return {term: weight / length for term, weight in vec.items()}
+
 def get_highest_sim(priority, clusters, avail):
     max_val = -10000
     i1 = -1
     i2 = -2
     # DOC_NUM -1 
-    for i in range(0, DOC_NUM-1):
+    for i in range(0, len(avail)-1):
         if avail[i] == 0:
             continue
         i3 = i
@@ -610,6 +947,25 @@ def get_highest_sim(priority, clusters, avail):
     return i1, i2
 
 
+def tokenize(text, stop_words, p):
+    words = []
+    data = re.split(TOKEN_SPLIT, text)
+    for token in data :
+        token = token.lower()
+        if token == '' or len(token) < MIN_TOKEN_LEN:
+            continue
+        if token in stop_words:
+            continue
+        if re.search(r'\d', token): # if token has number in it 
+            continue
+        words.append(p.stem(token, 0,len(token)-1))
+    return words
+
+
+def tokenizer_settings(stop_words):
+    return {'split': TOKEN_SPLIT, 'min_len': MIN_TOKEN_LEN, 'stop_words': sorted(stop_words), 'stemmer': STEMMER_ID}
+
+
 def cos_similarity(doc1, doc2):
     result = 1 - spatial.distance.cosine(doc1, doc2)
     # print(result)
@@ -618,6 +974,20 @@ def cos_similarity(doc1, doc2):
 
 
 if __name__ == '__main__':
-    main()
+    # python HAC_clustering.py [--resume]
+    # python HAC_clustering.py buckshot <k> [k-means passes]
+    # python HAC_clustering.py lsi                cluster the reduced vectors of lsi.npz
+    # python HAC_clustering.py quantized          cluster vector.q with a float16 similarity matrix
+    # python HAC_clustering.py quantize_report    partition changes of vector.q against vector/
+    if len(sys.argv) > 2 and sys.argv[1] == 'buckshot':
+        buckshot_main(int(sys.argv[2]), int(sys.argv[3]) if len(sys.argv) > 3 else 0)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'lsi':
+        lsi_main()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'quantized':
+        quantized_main()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'quantize_report':
+        quantize_report()
+    else:
+        main(resume='--resume' in sys.argv)
 
     
\ No newline at end of file
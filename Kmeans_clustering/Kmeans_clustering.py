@@ -0,0 +1,124 @@
+import os
+import sys
+import numpy as np
+from scipy import sparse
+from multiprocessing import Pool
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Common'))
+from vectors import read_vectors
+
+
+VECTOR_PATH = '../Tf-idf_Vectors/vector/'
+K = 8
+RESTARTS = 4
+MAX_ITER = 100
+BATCH_SIZE = 0 # 0 for full batch updates, otherwise mini-batch size
+
+
+def main():
+    k = int(sys.argv[1]) if len(sys.argv) > 1 else K
+    restarts = int(sys.argv[2]) if len(sys.argv) > 2 else RESTARTS
+    batch_size = int(sys.argv[3]) if len(sys.argv) > 3 else BATCH_SIZE
+    doc_ids, X = read_vectors(VECTOR_PATH)
+    labels, score = parallel_kmeans(X, k, restarts, MAX_ITER, batch_size)
+    print(f'objective {score}')
+    groups = [[] for i in range(k)]
+    for doc_id, label in zip(doc_ids.tolist(), labels):
+        groups[label].append(doc_id)
+    write_result('result_' + str(k) + '.txt', [val for val in groups if val])
+
+
+def normalize_centroids(C):
+    norm = np.linalg.norm(C, axis=1)
+    norm[norm == 0] = 1
+    return C / norm[:, None]
+
+
+def kmeans_pp(X, k, rng):
+    # k-means++ seeding with d = 1 - cos, the distance on the unit sphere
+    num_doc = X.shape[0]
+    C = np.zeros((k, X.shape[1]))
+    first = rng.integers(num_doc)
+    C[0] = X[first].toarray().ravel()
+    dist = np.maximum(1 - X @ C[0], 0)
+    for c in range(1, k):
+        total = dist.sum()
+        if total > 0:
+            pick = rng.choice(num_doc, p=dist / total)
+        else:
+            pick = rng.integers(num_doc)
+        C[c] = X[pick].toarray().ravel()
+        dist = np.minimum(dist, np.maximum(1 - X @ C[c], 0))
+    return C
+
+
+def spherical_kmeans(X, k, max_iter, batch_size, seed):
+    rng = np.random.default_rng(seed)
+    num_doc = X.shape[0]
+    C = kmeans_pp(X, k, rng)
+    if batch_size:
+        counts = np.zeros(k)
+        for n in range(max_iter):
+            batch = rng.choice(num_doc, min(batch_size, num_doc), replace=False)
+            Xb = X[batch]
+            labels = np.asarray((Xb @ C.T).argmax(axis=1)).ravel()
+            member = sparse.csr_matrix((np.ones(len(batch)), (labels, np.arange(len(batch)))), shape=(k, len(batch)))
+            batch_count = np.asarray(member.sum(axis=1)).ravel()
+            counts += batch_count
+            # per center learning rate 1 / count, summed over the batch
+            update = (member @ Xb).toarray() - batch_count[:, None] * C
+            moved = batch_count > 0
+            C[moved] += update[moved] / counts[moved, None]
+            C = normalize_centroids(C)
+    labels = None
+    for n in range(max_iter):
+        # one sparse-by-dense product gives every document-centroid cosine
+        sims = X @ C.T
+        new_labels = np.asarray(sims.argmax(axis=1)).ravel()
+        if batch_size or (labels is not None and np.array_equal(labels, new_labels)):
+            labels = new_labels
+            break
+        labels = new_labels
+        member = sparse.csr_matrix((np.ones(num_doc), (labels, np.arange(num_doc))), shape=(k, num_doc))
+        C = (member @ X).toarray()
+        empty = np.flatnonzero(np.asarray(member.sum(axis=1)).ravel() == 0)
+        if len(empty):
+            # reseed empty clusters with the documents farthest from their centroid
+            far = np.argsort(sims[np.arange(num_doc), labels])[:len(empty)]
+            C[empty] = X[far].toarray()
+        C = normalize_centroids(C)
+    score = float(np.asarray(sims)[np.arange(num_doc), labels].sum())
+    return labels, score
+
+
+_X = None
+
+def init_worker(X):
+    global _X
+    _X = X
+
+
+def run_restart(args):
+    k, max_iter, batch_size, seed = args
+    return spherical_kmeans(_X, k, max_iter, batch_size, seed)
+
+
+def parallel_kmeans(X, k, restarts, max_iter, batch_size):
+    # independent restarts on a process pool, keep the one with the highest total cosine
+    jobs = [(k, max_iter, batch_size, seed) for seed in range(restarts)]
+    with Pool(min(restarts, os.cpu_count() or 1), initializer=init_worker, initargs=(X,)) as pool:
+        results = pool.map(run_restart, jobs)
+    return max(results, key=lambda d: d[1])
+
+
+def write_result(name, groups):
+    with open (name, 'w') as f:
+        for val in groups:
+            val.sort()
+            for _id in val:
+                f.write(str(_id))
+                f.write('\n')
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,25 @@
 import requests
 import re
+import os
 import sys
 import math
-from scipy import spatial
+import json
+import time
+import hashlib
+import inspect
+import struct
+import pickle
+import asyncio
+import http.client
+from multiprocessing import Pool
+import numpy as np
 import pandas as pd
+from scipy import sparse
+from scipy import special
 from nltk.corpus import stopwords
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Common'))
+from corpus_io import open_corpus, load_token_cache, cached_tokens, store_tokens, save_token_cache
+from vectors import vector_ids, hash_counts
 
 # for Porter's stemmer algorithm
 class PorterStemmer:
@@ -320,6 +335,33 @@ class PorterStemmer:
         return self.b[self.k0:self.k+1]
 
 
+FEATURE_NUM = 38 # top terms per class and selection method
+TOKEN_SPLIT = ' |\.|\'|\r|\n|\,|\?|\`|\(|\)|\-|\@|\"|\:|\_|\%|\#|\;|\/|\*|\$|\&|\!'
+MIN_TOKEN_LEN = 2
+MODEL_FILE = 'model.bin'
+STATS_FILE = 'nb_stats' # sufficient statistics for incremental training
+CV_FOLDS = 5
+CV_METHODS = ['chi', 'MI', 'likelyhood', 'mix']
+CV_COUNTS = [10, 20, 38, 50, 100, 200]
+MODEL_MAGIC = b'NBMODEL\0'
+MODEL_VERSION = 3 # 2 adds the model kind and the rocchio idf vector, 3 hashed models
+VECTOR_PATH = '../Tf-idf_Vectors/vector/'
+DICTIONARY_FILE = '../Tf-idf_Vectors/dictionary.txt'
+TOKENIZER_FILE = '../Tf-idf_Vectors/tokenizer.json' # tokenizer settings the vectors were built with
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 8650
+BATCH_WINDOW = 0.005 # seconds a batch waits for more requests
+MAX_BATCH = 256
+CHUNK_SIZE = 64 # documents per task in batch classification
+try:
+    # changes whenever PorterStemmer is edited, so cached stems are never reused across versions
+    STEMMER_ID = hashlib.sha1(inspect.getsource(PorterStemmer).encode()).hexdigest()[:16]
+except (OSError, TypeError):
+    STEMMER_ID = 'porter-1' # no source to hash (.pyc only, exec'd code), a fixed id keys the cache instead
+CORPUS = 'IRTM'
+HASH_BITS = 18 # hashed models score 2^HASH_BITS columns
+
+
 def main():
     stop_words = set(stopwords.words('english'))
     # res = requests.get('http://ir.dcs.gla.ac.uk/resources/linguistic_utils/stop_words')
@@ -327,13 +369,97 @@ def main():
     #     word = word.replace('\r','')
     #     stop_words.append(word.lower())
     p = PorterStemmer()
-    word_list = []
-    output = []
-    _id = 0
-    term_in_art = dict()
+    training_data, all_label_doc = read_training('training.txt')
+    settings = tokenizer_settings(stop_words)
+    cache = load_token_cache(open_corpus(CORPUS), settings)
+
+    label_docs = []
+    doc_words = []
+    for i in sorted(all_label_doc):
+        try:
+            doc_words.append(cached_tokens(cache, i, lambda text: tokenize(text, stop_words, p)))
+            label_docs.append(i)
+            print('finished' + ' '+str(i) + ' ' + 'document' )
+        except Exception as e:
+            #print(e)
+            print('finish')
+            break
+    save_token_cache(cache)
+
+    stats = new_stats()
+    stats['tokenizer'] = settings
+    partial_fit(stats, doc_words, label_docs, training_data)
+    select(stats, 'mix', FEATURE_NUM)
+    save_stats(stats)
+    batch_classify(all_label_doc, os.cpu_count() or 1)
+
+
+def batch_classify(all_label_doc, workers):
+    # unlabeled IRTM docs are cut into chunks, tokenized and scored on a process pool,
+    # every worker maps the same read-only model.bin
+    corpus = open_corpus(CORPUS)
+    id_list = [i for i in range(1, corpus['count'] + 1) if i not in all_label_doc]
+    chunks = [id_list[n:n + CHUNK_SIZE] for n in range(0, len(id_list), CHUNK_SIZE)]
+    label_list = []
+    cache = load_token_cache(corpus, load_model(MODEL_FILE)['tokenizer'])
+    with Pool(workers, initializer=init_classify_worker, initargs=(MODEL_FILE,)) as pool:
+        for labels, fresh in pool.imap(classify_chunk, chunks):
+            label_list += labels
+            for name, (mtime, size, digest, words) in fresh.items():
+                store_tokens(cache, name, mtime, size, digest, words)
+    save_token_cache(cache)
+    print(f'finished {len(id_list)} documents')
+    df = pd.DataFrame({'id': id_list,'Value':label_list})
+    df = df.astype(int)
+    df.to_csv('result.csv', index= False)
+
+
+_worker = dict()
+
+def init_classify_worker(name):
+    model = load_model(name)
+    _worker['model'] = model
+    _worker['stop_words'] = set(model['tokenizer']['stop_words'])
+    _worker['p'] = PorterStemmer()
+    _worker['cache'] = load_token_cache(open_corpus(CORPUS), model['tokenizer'])
+    _worker['cache']['fresh'] = dict()
+
+
+def classify_chunk(doc_ids):
+    # returns the labels and the newly tokenized docs for the parent's token cache
+    model = _worker['model']
+    settings = model['tokenizer']
+    cache = _worker['cache']
+    docs = []
+    for i in doc_ids:
+        docs.append(cached_tokens(cache, i, lambda text: tokenize(text, _worker['stop_words'], _worker['p'], settings['split'], settings['min_len'])))
+    best, score = predict(doc_matrix(model, docs), model['log_prior'], model['log_prob'])
+    fresh = cache['fresh']
+    cache['fresh'] = dict()
+    return [model['classes'][c] for c in best], fresh
+
+
+def read_docs(doc_ids, settings):
+    # stemmed tokens of the corpus documents through the token cache
+    stop_words = set(settings['stop_words'])
+    p = PorterStemmer()
+    cache = load_token_cache(open_corpus(CORPUS), settings)
+    docs = []
+    for i in doc_ids:
+        docs.append(cached_tokens(cache, i, lambda text: tokenize(text, stop_words, p, settings['split'], settings['min_len'])))
+    save_token_cache(cache)
+    return docs
+
+
+def tokenizer_settings(stop_words):
+    return {'split': TOKEN_SPLIT, 'min_len': MIN_TOKEN_LEN, 'stop_words': sorted(stop_words), 'stemmer': STEMMER_ID}
+
+
+def read_training(name):
+    # class id -> labeled doc ids, and the set of all labeled docs
     training_data = dict()
     all_label_doc = set()
-    with open ('training.txt','r') as f1:
+    with open (name,'r') as f1:
         for i in f1.readlines():
             splited = i.split(' ',1)
             class_id =  splited[0]
@@ -342,209 +468,695 @@ def main():
             for art in art_ids[:-1].split(' '):
                 temp.append(int(art))
                 all_label_doc.add(int(art))
-            training_data[class_id] = temp
-    
-    for i in all_label_doc:
-        try:
-            with open ('IRTM/' + str(i) + '.txt', 'r') as f :
-                temp = [] # record term id 
-                data = re.split(' |\.|\'|\r|\n|\,|\?|\`|\(|\)|\-|\@|\"|\:|\_|\%|\#|\;|\/|\*|\$|\&|\!', f.read())
-                for token in data :
-                    token = token.lower()
-                    if token is '' or len(token) < 2:
-                        continue
-                    if token in stop_words:
-                        continue
-                    if re.search(r'\d', token): # if token has number in it 
-                        continue
-                    stemmed_word = p.stem(token, 0,len(token)-1)
-                    if stemmed_word not in word_list:
-                        word_list.append(stemmed_word)
-                        output.append({'term': stemmed_word, 'df': 1 , 'all-tf':[{'id': i, 'tf':1}], 'id': _id, 'arts': set([i])})
-                        temp.append(_id)
-                        _id += 1
-                    else:
-                        index = word_list.index(stemmed_word)
-                        flag = 0
-                        for info in output[index]['all-tf']:
-                            if info['id'] == i:
-                                info['tf'] +=1
-                                flag = 1
-                                break
-                        if not flag:
-                            output[index]['all-tf'].append({'id': i, 'tf':1})
-                            output[index]['df'] += 1
-                        output[index]['arts'].add(i)
-                        temp.append(output[index]['id'])
-                            
-                term_in_art[i] = list(set(temp))
-            print('finished' + ' '+str(i) + ' ' + 'document' )
-        except Exception as e:
-            #print(e)
-            print('finish')
-            break
-    
-    num_doc = len(all_label_doc)
-    features_id = dict()
-    condprob = dict()
-    prior = dict()
-    all_tf = dict()
-    all_features = []
-    
-    for key, val in training_data.items():
-        other_label_doc = all_label_doc.difference(set(val))
-        class_id = key 
-        class_doc_num = len(val)
-        prior[key] = class_doc_num / num_doc
-        features_id[class_id]= select_feature(val, class_id, 500, output, term_in_art, other_label_doc, 'mix') # 500 top value in class docs
-        all_features += features_id[class_id]
-    
-    all_features = set(all_features)
-
-    for key, val in training_data.items():
-        all_term_tf = 0
-        class_id = key 
-        count = 0
-        for t in all_features:
-            tf_in_class = 0
-            for info in output[t]['all-tf']:
-                if info['id'] in val:
-                    tf_in_class += info['tf']
-            all_tf[f'{output[t]["term"]}_{class_id}'] = tf_in_class
-            all_term_tf += tf_in_class
-        for t in all_features:
-            condprob[f'{output[t]["term"]}_{class_id}'] = (all_tf[f'{output[t]["term"]}_{class_id}'] + 1) / (all_term_tf + len(features_id[class_id]))
-        print(f'class {class_id} finished')
-    text_file = 1 
+            # a class may come back on a later line with newly labeled docs
+            training_data[class_id] = training_data.get(class_id, []) + temp
+    return training_data, all_label_doc
 
-    label_list = []
-    id_list = []
-    while True:
-        if text_file in all_label_doc:
-            text_file += 1  
-            continue 
-        try:
-            all_words = list()
-            with open ('IRTM/' + str(text_file) + '.txt', 'r') as f :
-                id_list.append(text_file)
-                data = re.split(' |\.|\'|\r|\n|\,|\?|\`|\(|\)|\-|\@|\"|\:|\_|\%|\#|\;|\/|\*|\$|\&|\!', f.read())
-                for token in data :
-                    token = token.lower()
-                    if token is '' or len(token) < 2:
-                        continue
-                    if token in stop_words:
-                        continue
-                    if re.search(r'\d', token): # if token has number in it 
-                        continue
-                    stemmed_word = p.stem(token, 0,len(token)-1)
-                    all_words.append(stemmed_word)
-            score = dict()
-            for class_id in training_data.keys():
-                score[class_id] = math.log(prior[class_id])
-                for term in all_words:
-                    if condprob.get(f'{term}_{class_id}') != None:
-                        score[class_id] += math.log(condprob[f'{term}_{class_id}'])
-            max_val = -100000
-            label = -1
-            for key, value in score.items():
-                if value > max_val:
-                    max_val = value
-                    label = key
-            label_list.append(label)
-            print(f'finished doc {text_file}')
-            text_file += 1
-        except Exception as e:
-            #print(e)
-            print('finish')
-            break
+
+def new_stats(classes=(), vocab=None):
+    # sufficient statistics: class x term counts, term x class document frequencies,
+    # docs per term and per class, the classes every doc was counted under and the current
+    # feature selection
+    vocab = dict() if vocab is None else vocab
+    num_class = len(classes)
+    num_term = len(vocab)
+    return {'classes': list(classes), 'vocab': vocab, 'doc_ids': set(), 'labels': dict(), 'num_doc': 0,
+            'class_term': np.zeros((num_class, num_term)), 'df': np.zeros((num_term, num_class)),
+            'term_df': np.zeros(num_term), 'class_size': np.zeros(num_class),
+            'selected': [[] for c in classes]}
+
+
+def grow(stats, doc_words, doc_ids, training_data):
+    # new classes of these docs and new terms of their words get zero rows and columns
+    for class_id in training_data:
+        if class_id not in stats['classes'] and set(training_data[class_id]).intersection(doc_ids):
+            stats['classes'].append(class_id)
+            stats['selected'].append([])
+    vocab = stats['vocab']
+    for words in doc_words:
+        for word in words:
+            if word not in vocab:
+                vocab[word] = len(vocab)
+    num_class = len(stats['classes'])
+    num_term = len(vocab)
+    old_class, old_term = stats['class_term'].shape
+    stats['class_term'] = np.pad(stats['class_term'], ((0, num_class - old_class), (0, num_term - old_term)))
+    stats['df'] = np.pad(stats['df'], ((0, num_term - old_term), (0, num_class - old_class)))
+    stats['term_df'] = np.pad(stats['term_df'], (0, num_term - old_term))
+    stats['class_size'] = np.pad(stats['class_size'], (0, num_class - old_class))
+
+
+def doc_labels(doc_ids, training_data):
+    # doc id -> sorted class ids training.txt lists it under
+    labels = {doc: set() for doc in doc_ids}
+    for class_id, docs in training_data.items():
+        for doc in docs:
+            if doc in labels:
+                labels[doc].add(class_id)
+    return {doc: sorted(classes) for doc, classes in labels.items()}
+
+
+def partial_fit(stats, doc_words, doc_ids, training_data):
+    # add a batch of newly labeled docs, cost depends on the batch only (plus array growth)
+    seen = stats['doc_ids'].intersection(doc_ids)
+    if seen:
+        raise ValueError(f'documents {sorted(seen)} are already in the model')
+    grow(stats, doc_words, doc_ids, training_data)
+    add_counts(stats, count_matrix(doc_words, stats['vocab']), class_matrix(doc_ids, training_data, stats['classes']))
+    stats['doc_ids'].update(doc_ids)
+    stats['labels'].update(doc_labels(doc_ids, training_data))
+
+
+def relabeled(stats, training_data):
+    # trained docs that training.txt now lists under more classes; a doc that lost a class
+    # cannot be taken back out of the counts
+    labels = doc_labels(stats['doc_ids'], training_data)
+    lost = sorted(doc for doc, classes in labels.items() if not set(stats['labels'][doc]) <= set(classes))
+    if lost:
+        raise ValueError(f'documents {lost} lost a class in training.txt, retrain with a full run')
+    return sorted(doc for doc, classes in labels.items() if classes != stats['labels'][doc])
+
+
+def add_labels(stats, doc_words, doc_ids, training_data):
+    # count trained docs under their new classes as a full retrain would; their terms and
+    # the doc itself are in term_df and num_doc already
+    grow(stats, doc_words, doc_ids, training_data)
+    labels = doc_labels(doc_ids, training_data)
+    added = {class_id: [doc for doc in doc_ids if class_id in labels[doc] and class_id not in stats['labels'][doc]]
+             for class_id in stats['classes']}
+    doc_term = count_matrix(doc_words, stats['vocab'])
+    class_doc = class_matrix(doc_ids, added, stats['classes'])
+    stats['class_term'] += (class_doc.T @ doc_term).toarray()
+    stats['df'] += ((doc_term > 0).astype(float).T @ class_doc).toarray()
+    stats['class_size'] += np.asarray(class_doc.sum(axis=0)).ravel()
+    stats['labels'].update(labels)
+
+
+def add_counts(stats, doc_term, class_doc):
+    # doc_term: [docs x terms] counts over stats['vocab'], class_doc: [docs x classes] labels
+    presence = (doc_term > 0).astype(float)
+    stats['class_term'] += (class_doc.T @ doc_term).toarray()
+    stats['df'] += (presence.T @ class_doc).toarray()
+    stats['term_df'] += np.asarray(presence.sum(axis=0)).ravel()
+    stats['class_size'] += np.asarray(class_doc.sum(axis=0)).ravel()
+    stats['num_doc'] += doc_term.shape[0]
+
+
+def select(stats, method, count, classes=None):
+    # (re)select features for the given class indexes, all classes by default
+    terms = list(stats['vocab'])
+    tie = np.argsort(np.argsort(terms, kind='stable'), kind='stable') # ties go by term, not by arrival order
+    selected = select_feature(stats['df'], stats['term_df'], stats['class_size'], stats['num_doc'], method, count, tie)
+    for c in (range(len(stats['classes'])) if classes is None else classes):
+        stats['selected'][c] = selected[c]
+    stats['method'] = method
+    stats['count'] = count
+
+
+def build_model(stats):
+    # Laplace smoothed log probabilities over the selected features
+    selected = stats['selected']
+    all_features = sorted(set().union(*selected))
+    counts = stats['class_term'][:, all_features]
+    num_selected = np.array([len(ids) for ids in selected])
+    log_prob = np.log((counts + 1) / (counts.sum(axis=1) + num_selected)[:, None])
+    log_prior = np.log(stats['class_size'] / stats['num_doc'])
+    terms = list(stats['vocab'])
+    lexicon = {terms[t]: n for n, t in enumerate(all_features)}
+    return {'classes': list(stats['classes']), 'lexicon': lexicon, 'log_prior': log_prior, 'log_prob': log_prob}
+
+
+def update(reselect):
+    # train on the labeled docs of training.txt that the saved statistics have not seen yet,
+    # and count seen docs under the classes they were given since
+    with open(STATS_FILE, 'rb') as f:
+        stats = pickle.load(f)
+    if 'labels' not in stats:
+        raise ValueError(f'{STATS_FILE} does not record the classes of its documents, retrain with a full run')
+    training_data, all_label_doc = read_training('training.txt')
+    new_docs = sorted(all_label_doc.difference(stats['doc_ids']))
+    relabel_docs = relabeled(stats, training_data)
+    num_class = len(stats['classes'])
+    partial_fit(stats, read_docs(new_docs, stats['tokenizer']), new_docs, training_data)
+    if relabel_docs:
+        add_labels(stats, read_docs(relabel_docs, stats['tokenizer']), relabel_docs, training_data)
+    if reselect or relabel_docs:
+        # a relabel changes the counts of classes that already have a selection
+        select(stats, stats['method'], stats['count'])
+    else:
+        # only new classes get a selection, the others keep their features
+        select(stats, stats['method'], stats['count'], range(num_class, len(stats['classes'])))
+    print(f'added {len(new_docs)} documents, relabeled {len(relabel_docs)}')
+    save_stats(stats)
+
+
+def save_stats(stats):
+    # model.bin and the statistics it was built from are always written together
+    model = build_model(stats)
+    model['tokenizer'] = stats['tokenizer']
+    save_model(MODEL_FILE, model)
+    with open(STATS_FILE + '.tmp', 'wb') as f:
+        pickle.dump(stats, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(STATS_FILE + '.tmp', STATS_FILE)
+    return model
+
+
+def cross_validate(folds, workers):
+    # labeled docs are tokenized and counted once, every (fold, method) task then trains
+    # on row slices of the shared count matrix for all feature counts of the grid
+    training_data, all_label_doc = read_training('training.txt')
+    doc_ids = sorted(all_label_doc)
+    doc_words = read_docs(doc_ids, tokenizer_settings(stopwords.words('english')))
+    classes = list(training_data.keys())
+    vocab = build_lexicon(doc_words)
+    doc_term = count_matrix(doc_words, vocab)
+    class_doc = class_matrix(doc_ids, training_data, classes)
+
+    # stratified folds: the docs of each class are dealt round-robin
+    fold_of = np.zeros(len(doc_ids), dtype=int)
+    first_class = np.asarray(class_doc.argmax(axis=1)).ravel()
+    for c in range(len(classes)):
+        rows = np.flatnonzero(first_class == c)
+        fold_of[rows] = np.arange(len(rows)) % folds
+
+    start = time.time()
+    tasks = [(fold, method) for fold in range(folds) for method in CV_METHODS]
+    shared = (vocab, classes, doc_term, class_doc, fold_of)
+    with Pool(min(len(tasks), workers), initializer=init_cv_worker, initargs=(shared,)) as pool:
+        results = [row for rows in pool.map(cv_task, tasks) for row in rows]
+    df = pd.DataFrame(results, columns=['method', 'count', 'fold', 'correct', 'total', 'train_time', 'predict_time'])
+    report = df.groupby(['method', 'count'], sort=False).agg(
+        correct=('correct', 'sum'), total=('total', 'sum'),
+        train_time=('train_time', 'mean'), predict_time=('predict_time', 'mean')).reset_index()
+    report['accuracy'] = report['correct'] / report['total']
+    report = report[['method', 'count', 'accuracy', 'train_time', 'predict_time']]
+    print(report.sort_values('accuracy', ascending=False).to_string(index=False))
+    print(f'{len(tasks)} tasks, {len(report)} configurations in {time.time() - start:.2f}s')
+    report.to_csv('cv_result.csv', index= False)
+
+
+_cv = dict()
+
+def init_cv_worker(shared):
+    _cv['shared'] = shared
+
+
+def cv_task(task):
+    fold, method = task
+    vocab, classes, doc_term, class_doc, fold_of = _cv['shared']
+    train_rows = np.flatnonzero(fold_of != fold)
+    test_rows = np.flatnonzero(fold_of == fold)
+    stats = new_stats(classes, vocab)
+    add_counts(stats, doc_term[train_rows], class_doc[train_rows])
+    test_term = doc_term[test_rows]
+    test_class = class_doc[test_rows].toarray()
+    ret = []
+    for count in CV_COUNTS:
+        start = time.time()
+        select(stats, method, count)
+        model = build_model(stats)
+        features = [vocab[term] for term in sorted(model['lexicon'], key=model['lexicon'].get)]
+        train_time = time.time() - start
+        start = time.time()
+        best, score = predict(test_term[:, features], model['log_prior'], model['log_prob'])
+        predict_time = time.time() - start
+        correct = int(test_class[np.arange(len(test_rows)), best].sum())
+        ret.append((method, count, fold, correct, len(test_rows), train_time, predict_time))
+    return ret
+
+
+def classify(paths):
+    # label documents with the saved model only, training.txt and the corpus are not read
+    model = load_model(MODEL_FILE)
+    settings = model['tokenizer']
+    stop_words = set(settings['stop_words'])
+    p = PorterStemmer()
+    docs = []
+    for path in paths:
+        with open(path, 'r') as f:
+            docs.append(tokenize(f.read(), stop_words, p, settings['split'], settings['min_len']))
+    best, score = predict(doc_matrix(model, docs), model['log_prior'], model['log_prob'])
+    id_list = [os.path.basename(path).rsplit('.', 1)[0] for path in paths]
+    label_list = [model['classes'][c] for c in best]
     df = pd.DataFrame({'id': id_list,'Value':label_list})
-    df = df.astype(int)
     df.to_csv('result.csv', index= False)
 
 
-def select_feature(doc_ids, class_id, count, output, term_in_art, other_label_doc, method):
-    if method == 'likelyhood':
-        val_list = dict()
-        for doc in doc_ids:
-            for term in term_in_art[doc]:
-                n11 = len(output[term]['arts'].intersection(doc_ids))
-                n01 = len(output[term]['arts'].intersection(other_label_doc))
-                n10 = len(doc_ids) - n11
-                n00 = len(doc_ids)+ len(other_label_doc) - n01 - n11- n10
-                N = n11 + n00 + n01 + n10
-                numerator = math.pow((n11+n01)/N, n11 + n01)  * math.pow(1-(n11+n01)/N, n10+n00) 
-                denominator = math.pow( n11 / (n11 + n10), n11 )  * math.pow(1-(n11 / (n11 + n10)), n10) * \
-                            math.pow( n01 / (n01 + n00), n01 )  * math.pow(1-(n01 / (n01 + n00)), n00) 
-                val =  -2 * math.log(numerator/ denominator, 10) 
-                val_list[term] = val
-        ret = sorted(val_list.items(), key=lambda d: d[1],reverse=True)
-        ans_id = []
-        ans_term = []
-        for i in ret[:38]:
-            #print(output[i[0]]['term'], i[1])
-            ans_id.append(i[0])
-        return ans_id
-    elif method == 'chi': # chi
-        val_list = dict()
-        test = dict()
-        for doc in doc_ids:
-            for term in term_in_art[doc]:
-                n11 = len(output[term]['arts'].intersection(doc_ids)) 
-                n01 = len(output[term]['arts'].intersection(other_label_doc))
-                if n11 ==0:
-                    continue
-                n10 = len(doc_ids) - n11
-                n00 = len(doc_ids)+ len(other_label_doc) - n01 - n11- n10
-                N = n11 + n00 + n01 + n10
-                e11 = N * (n11+n01)/N * (n11+n10)/N
-                e01 = N * (n01+n00)/N * (n11+n01)/N
-                e10 = N * (n11+n10)/N * (n00+n10)/N
-                e00 = N * (n00+n01)/N * (n00+n10)/N
-                val =  math.pow((n11-e11), 2) / e11 +  math.pow((n10-e10), 2) / e10 +  math.pow((n01-e01), 2) / e01 +  math.pow((n00-e00), 2) / e00
-                val_list[term] = val
-        ret = sorted(val_list.items(), key=lambda d: d[1],reverse=True)
-        ans_id = []
-        ans_term = []
-        flag = 0
-        for i in ret[:38]:
-            ans_id.append(i[0])
-        return ans_id
-    elif method == 'MI':
-        val_list = dict()
-        for doc in doc_ids:
-            for term in term_in_art[doc]:
-                n11 = len(output[term]['arts'].intersection(doc_ids)) 
-                n01 = len(output[term]['arts'].intersection(other_label_doc))
-                n10 = len(doc_ids) - n11
-                n00 = len(doc_ids)+ len(other_label_doc) - n01 - n11- n10
-                N = n11 + n00 + n01 + n10
-                n1_ = n11 + n10
-                n_1 = n01 + n11
-                n0_ = n00 + n01
-                n_0 = n00 + n10
-                first = (n11/N)* math.log((N*n11)/(n1_ +n_1),2) if n11 else 0
-                second = (n01/N)* math.log((N*n01)/(n0_ +n_1),2) if n01 else 0
-                third = (n10/N)* math.log((N*n10)/(n1_ +n_0),2) if n10 else 0
-                forth = (n00/N)* math.log((N*n00)/(n0_ +n_0),2) if n00 else 0
-                val =  first + second + third + forth
-                val_list[term] = val
-        ret = sorted(val_list.items(), key=lambda d: d[1],reverse=True)
-        ans_id = []
-        ans_term = []
-        for i in ret[:38]:
-            ans_id.append(i[0])
-        return ans_id
-    elif method == 'mix':
-        ans = set(select_feature(doc_ids, class_id, count, output, term_in_art, other_label_doc, 'chi'))
-        ans = ans.intersection(set(select_feature(doc_ids, class_id, count, output, term_in_art, other_label_doc, 'MI'))) 
-        ans = ans.intersection(set(select_feature(doc_ids, class_id, count, output, term_in_art, other_label_doc, 'likelyhood')))    
-        return ans
+class NBServer:
+    # POST /classify {"texts": [...]} -> {"labels": [...], "scores": [{class: score}, ...]}
+    # GET /metrics -> latency and throughput counters
+
+    def __init__(self, model):
+        self.model = model
+        settings = model['tokenizer']
+        self.stop_words = set(settings['stop_words'])
+        self.split = settings['split']
+        self.min_len = settings['min_len']
+        self.p = PorterStemmer()
+        self.queue = None
+        self.start = time.time()
+        self.requests = 0
+        self.docs = 0
+        self.batches = 0
+        self.latency = [] # seconds, last 10000 requests
+
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + BATCH_WINDOW
+            while len(batch) < MAX_BATCH:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            best, score = predict(doc_matrix(self.model, [words for words, fut in batch]),
+                                  self.model['log_prior'], self.model['log_prob'])
+            self.batches += 1
+            for n, (words, fut) in enumerate(batch):
+                if not fut.done():
+                    fut.set_result((self.model['classes'][best[n]], score[n]))
+
+    async def classify(self, texts):
+        loop = asyncio.get_running_loop()
+        futures = []
+        for text in texts:
+            fut = loop.create_future()
+            await self.queue.put((tokenize(text, self.stop_words, self.p, self.split, self.min_len), fut))
+            futures.append(fut)
+        results = await asyncio.gather(*futures)
+        classes = self.model['classes']
+        return {'labels': [label for label, score in results],
+                'scores': [dict(zip(classes, score.tolist())) for label, score in results]}
+
+    def metrics(self):
+        latency = sorted(self.latency)
+        def pct(q):
+            return latency[min(len(latency) - 1, int(q * len(latency)))] * 1000 if latency else 0
+        uptime = time.time() - self.start
+        return {'requests': self.requests, 'docs': self.docs, 'batches': self.batches,
+                'mean_batch': self.docs / self.batches if self.batches else 0,
+                'docs_per_sec': self.docs / uptime if uptime else 0,
+                'latency_ms': {'p50': pct(0.5), 'p95': pct(0.95), 'p99': pct(0.99)}}
+
+    async def handle(self, reader, writer):
+        # minimal HTTP/1.1 with keep-alive
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, path = line.decode('latin-1').split()[:2]
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, val = line.decode('latin-1').split(':', 1)
+                    headers[key.strip().lower()] = val.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                start = time.time()
+                status = '200 OK'
+                if method == 'POST' and path == '/classify':
+                    try:
+                        data = json.loads(body or b'{}')
+                        texts = data['texts'] if 'texts' in data else [data['text']]
+                        ret = await self.classify(texts)
+                        self.requests += 1
+                        self.docs += len(texts)
+                        self.latency.append(time.time() - start)
+                        del self.latency[:-10000]
+                    except (ValueError, KeyError, TypeError) as e:
+                        status = '400 Bad Request'
+                        ret = {'error': str(e)}
+                elif method == 'GET' and path == '/metrics':
+                    ret = self.metrics()
+                else:
+                    status = '404 Not Found'
+                    ret = {'error': f'no route {method} {path}'}
+                out = json.dumps(ret).encode('utf-8')
+                writer.write(f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(out)}\r\n\r\n'.encode('latin-1') + out)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def run(self, port=SERVER_PORT, socket_path=None):
+        self.queue = asyncio.Queue()
+        batcher = asyncio.create_task(self.batcher())
+        if socket_path:
+            server = await asyncio.start_unix_server(self.handle, path=socket_path)
+        else:
+            server = await asyncio.start_server(self.handle, SERVER_HOST, port)
+        print(f'serving on {socket_path or f"{SERVER_HOST}:{port}"}')
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+
+def serve(target):
+    # target is a TCP port or a unix socket path
+    server = NBServer(load_model(MODEL_FILE))
+    if target and not target.isdigit():
+        asyncio.run(server.run(socket_path=target))
     else:
+        asyncio.run(server.run(port=int(target) if target else SERVER_PORT))
+
+
+def request_labels(texts, port=SERVER_PORT):
+    # local client for the classification server
+    conn = http.client.HTTPConnection(SERVER_HOST, port)
+    conn.request('POST', '/classify', json.dumps({'texts': texts}), {'Content-Type': 'application/json'})
+    ret = json.loads(conn.getresponse().read())
+    conn.close()
+    return ret
+
+
+def save_model(name, model):
+    # magic, version, header length, JSON header (kind, classes, feature terms in column order,
+    # tokenizer settings, hash bits), then float64 log priors, the log probability table and
+    # for rocchio the idf vector, 8-byte aligned
+    classes = model['classes']
+    terms = sorted(model['lexicon'], key=model['lexicon'].get)
+    kind = model.get('kind', 'nb')
+    meta = {'kind': kind, 'classes': classes, 'terms': terms, 'tokenizer': model['tokenizer'],
+            'shape': list(model['log_prob'].shape)}
+    if kind == 'hashed':
+        meta['bits'] = model['bits']
+    header = json.dumps(meta).encode('utf-8')
+    with open(name + '.tmp', 'wb') as f:
+        f.write(MODEL_MAGIC)
+        f.write(struct.pack('<II', MODEL_VERSION, len(header)))
+        f.write(header)
+        f.write(b'\0' * (-f.tell() % 8))
+        f.write(np.ascontiguousarray(model['log_prior'], dtype='<f8').tobytes())
+        f.write(np.ascontiguousarray(model['log_prob'], dtype='<f8').tobytes())
+        if kind == 'rocchio':
+            f.write(np.ascontiguousarray(model['idf'], dtype='<f8').tobytes())
+    os.replace(name + '.tmp', name)
+
+
+def load_model(name):
+    with open(name, 'rb') as f:
+        if f.read(len(MODEL_MAGIC)) != MODEL_MAGIC:
+            raise ValueError(f'{name} is not a model file')
+        version, header_len = struct.unpack('<II', f.read(8))
+        if version > MODEL_VERSION:
+            raise ValueError(f'{name} has model version {version}, expected {MODEL_VERSION} or older')
+        header = json.loads(f.read(header_len).decode('utf-8'))
+        offset = f.tell() + (-f.tell() % 8)
+    kind = header.get('kind', 'nb')
+    num_class, num_feature = header['shape']
+    size = num_class + num_class * num_feature + (num_feature if kind == 'rocchio' else 0)
+    buf = np.memmap(name, dtype='<f8', mode='r', offset=offset, shape=(size,))
+    model = {'kind': kind,
+             'classes': header['classes'],
+             'lexicon': {term: n for n, term in enumerate(header['terms'])},
+             'log_prior': buf[:num_class],
+             'log_prob': buf[num_class:num_class + num_class * num_feature].reshape(num_class, num_feature),
+             'tokenizer': header['tokenizer']}
+    if kind == 'rocchio':
+        model['idf'] = buf[num_class + num_class * num_feature:]
+    if kind == 'hashed':
+        model['bits'] = header['bits']
+    return model
+
+
+def doc_matrix(model, docs):
+    # what the model scores: term counts for NB, unit length tf-idf rows for rocchio,
+    # unsigned hashed counts for a hashed NB model
+    if model.get('kind', 'nb') == 'hashed':
+        return hash_counts(docs, model['bits'], signed=False)
+    X = count_matrix(docs, model['lexicon'])
+    if model.get('kind', 'nb') == 'rocchio':
+        X = normalize_rows(X.multiply(np.asarray(model['idf'])[None, :]).tocsr())
+    return X
+
+
+def normalize_rows(X):
+    norm = np.sqrt(np.asarray(X.multiply(X).sum(axis=1)).ravel())
+    norm[norm == 0] = 1
+    return (sparse.diags(1 / norm) @ X).tocsr()
+
+
+def train_rocchio(training_data, vector_path, dictionary_file):
+    # class centroids of the unit length tf-idf vectors written by Tf-idf_Vectors. The nearest
+    # centroid maximizes 2 x.c - |c|^2, so 2c and -|c|^2 go where NB keeps log_prob and log_prior
+    terms = []
+    df = []
+    with open(dictionary_file, 'r') as f:
+        for line in f.readlines()[1:]:
+            index, term, term_df = line.split()
+            terms.append(term)
+            df.append(int(term_df))
+    # an exported index has no vector for removed documents, those are left out of training
+    exported = set(vector_ids(vector_path))
+    num_doc = len(exported)
+    doc_ids = sorted(set(doc for val in training_data.values() for doc in val) & exported)
+    indptr = [0]
+    indices = []
+    data = []
+    for i in doc_ids:
+        with open(vector_path + str(i) + '.txt', 'r') as f:
+            for line in f.readlines()[2:]:
+                t_index, tf_idf = line.split()
+                indices.append(int(t_index) - 1) # t_index starts from one
+                data.append(float(tf_idf))
+        indptr.append(len(indices))
+    X = normalize_rows(sparse.csr_matrix((data, indices, indptr), shape=(len(doc_ids), len(terms))))
+    classes = list(training_data.keys())
+    class_doc = class_matrix(doc_ids, training_data, classes)
+    class_size = np.asarray(class_doc.sum(axis=0)).ravel()
+    if not class_size.all():
+        raise ValueError(f'class {classes[int(np.argmin(class_size))]} has no training document in {vector_path}')
+    centroids = (class_doc.T @ X).toarray() / class_size[:, None]
+    return {'kind': 'rocchio',
+            'classes': classes,
+            'lexicon': {term: n for n, term in enumerate(terms)},
+            'log_prior': -(centroids ** 2).sum(axis=1),
+            'log_prob': 2 * centroids,
+            'idf': np.log10(num_doc / np.array(df, dtype=float))}
+
+
+def vector_tokenizer(name):
+    # the settings Tf-idf_Vectors saved, or its stop word list for vectors built before it did
+    if os.path.exists(name):
+        with open(name, 'r') as f:
+            return json.load(f)
+    stop_words = []
+    res = requests.get('http://ir.dcs.gla.ac.uk/resources/linguistic_utils/stop_words')
+    for word in res.text.split('\n'):
+        word = word.replace('\r','')
+        stop_words.append(word.lower())
+    return tokenizer_settings(stop_words)
+
+
+def rocchio_main():
+    # train the rocchio model into model.bin and label the unlabeled IRTM docs like main()
+    training_data, all_label_doc = read_training('training.txt')
+    model = train_rocchio(training_data, VECTOR_PATH, DICTIONARY_FILE)
+    # new documents have to be tokenized like the vectors the centroids came from
+    model['tokenizer'] = vector_tokenizer(TOKENIZER_FILE)
+    save_model(MODEL_FILE, model)
+    batch_classify(all_label_doc, os.cpu_count() or 1)
+
+
+def train_hashed(doc_words, doc_ids, training_data, bits):
+    # multinomial NB over every hashed column, no vocabulary and no feature selection;
+    # counts stay unsigned, the classifier needs them non-negative
+    classes = list(training_data.keys())
+    class_doc = class_matrix(doc_ids, training_data, classes)
+    counts = (class_doc.T @ hash_counts(doc_words, bits, signed=False)).toarray()
+    class_size = np.asarray(class_doc.sum(axis=0)).ravel()
+    return {'kind': 'hashed',
+            'classes': classes,
+            'lexicon': dict(),
+            'bits': bits,
+            'log_prior': np.log(class_size / len(doc_ids)),
+            'log_prob': np.log((counts + 1) / (counts.sum(axis=1) + (1 << bits))[:, None])}
+
+
+def hashed_main(bits):
+    # train a hashed model.bin and label the unlabeled IRTM docs like main()
+    training_data, all_label_doc = read_training('training.txt')
+    settings = tokenizer_settings(stopwords.words('english'))
+    doc_ids = sorted(all_label_doc)
+    model = train_hashed(read_docs(doc_ids, settings), doc_ids, training_data, bits)
+    model['tokenizer'] = settings
+    save_model(MODEL_FILE, model)
+    batch_classify(all_label_doc, os.cpu_count() or 1)
+
+
+def tokenize(text, stop_words, p, split=TOKEN_SPLIT, min_len=MIN_TOKEN_LEN):
+    words = []
+    data = re.split(split, text)
+    for token in data :
+        token = token.lower()
+        if token == '' or len(token) < min_len:
+            continue
+        if token in stop_words:
+            continue
+        if re.search(r'\d', token): # if token has number in it 
+            continue
+        words.append(p.stem(token, 0,len(token)-1))
+    return words
+
+
+def build_lexicon(docs):
+    # term -> id in order of first occurrence
+    lexicon = dict()
+    for words in docs:
+        for word in words:
+            if word not in lexicon:
+                lexicon[word] = len(lexicon)
+    return lexicon
+
+
+def count_matrix(docs, lexicon):
+    # [docs x features] term counts, words outside the lexicon are dropped
+    indptr = [0]
+    indices = []
+    for words in docs:
+        for word in words:
+            col = lexicon.get(word)
+            if col is not None:
+                indices.append(col)
+        indptr.append(len(indices))
+    X = sparse.csr_matrix((np.ones(len(indices)), indices, indptr), shape=(len(docs), len(lexicon)))
+    X.sum_duplicates()
+    return X
+
+
+def predict(X, log_prior, log_prob):
+    # the whole batch in one sparse-dense product, returns the best class index and all scores
+    score = np.asarray(X @ log_prob.T) + log_prior
+    return score.argmax(axis=1), score
+
+
+def select_feature(df, term_df, class_size, num_doc, method, count, tie=None):
+    # df: [terms x classes] number of labeled docs of the class containing the term,
+    # term_df: labeled docs containing the term, returns the top `count` term ids per class,
+    # equal scores are ordered by tie (term id by default)
+    if method == 'mix':
+        ans = [set(ids) for ids in select_feature(df, term_df, class_size, num_doc, 'chi', count, tie)]
+        for other in ('MI', 'likelyhood'):
+            for c, ids in enumerate(select_feature(df, term_df, class_size, num_doc, other, count, tie)):
+                ans[c] = ans[c].intersection(ids)
+        return ans
+    scores = feature_scores(df, term_df, class_size, num_doc, method)
+    if scores is None:
         return None
+    if tie is None:
+        tie = np.arange(scores.shape[0])
+    ans = []
+    for c in range(scores.shape[1]):
+        col = scores[:, c]
+        k = min(count, int(np.isfinite(col).sum()))
+        if k == 0:
+            ans.append([])
+            continue
+        # every term tied with the k-th score is a candidate, so the cut does not depend on argpartition
+        kth = -np.partition(-col, k - 1)[k - 1]
+        top = np.flatnonzero(col >= kth)
+        top = top[np.lexsort((tie[top], -col[top]))][:k]
+        ans.append(top.tolist())
+    return ans
+
+
+def feature_scores(df, term_df, class_size, num_doc, method):
+    # contingency counts for every term and class at once, terms absent from the class get -inf
+    n11 = df.astype(float)
+    n01 = term_df[:, None] - n11
+    n10 = class_size[None, :] - n11
+    n00 = (num_doc - class_size)[None, :] - n01
+    N = num_doc
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if method == 'likelyhood':
+            p = (n11 + n01) / N
+            p1 = n11 / (n11 + n10)
+            p0 = n01 / (n01 + n00)
+            numerator = special.xlogy(n11 + n01, p) + special.xlogy(n10 + n00, 1 - p)
+            denominator = special.xlogy(n11, p1) + special.xlogy(n10, 1 - p1) + \
+                        special.xlogy(n01, p0) + special.xlogy(n00, 1 - p0)
+            val = -2 * (numerator - denominator) / math.log(10)
+        elif method == 'chi':
+            e11 = (n11 + n01) * (n11 + n10) / N
+            e01 = (n01 + n00) * (n11 + n01) / N
+            e10 = (n11 + n10) * (n00 + n10) / N
+            e00 = (n00 + n01) * (n00 + n10) / N
+            val = 0
+            for n, e in ((n11, e11), (n10, e10), (n01, e01), (n00, e00)):
+                val = val + np.where(e > 0, (n - e) ** 2 / e, 0)
+        elif method == 'MI':
+            n1_ = n11 + n10
+            n_1 = n01 + n11
+            n0_ = n00 + n01
+            n_0 = n00 + n10
+            val = 0
+            for n, a, b in ((n11, n1_, n_1), (n01, n0_, n_1), (n10, n1_, n_0), (n00, n0_, n_0)):
+                val = val + np.where(n > 0, (n / N) * np.log2(N * n / (a + b)), 0)
+        else:
+            return None
+    return np.where(n11 > 0, val, -np.inf)
+
+
+def class_matrix(doc_ids, training_data, classes):
+    # [docs x classes] indicator of the class labels
+    row_of = {doc: r for r, doc in enumerate(doc_ids)}
+    rows = []
+    cols = []
+    for c, class_id in enumerate(classes):
+        for doc in set(training_data[class_id]):
+            if doc in row_of:
+                rows.append(row_of[doc])
+                cols.append(c)
+    return sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(doc_ids), len(classes)))
+
+
 def asending(elem):
     return elem['term']
 
 
 if __name__ == '__main__':
-    main()
+    # python Multinomial_NB_Classifier.py                        train, save model.bin, label IRTM
+    # python Multinomial_NB_Classifier.py classify <file> ...    label files with model.bin
+    # python Multinomial_NB_Classifier.py serve [port | socket]   serve model.bin over HTTP
+    # python Multinomial_NB_Classifier.py client <file> ...      label files through the server
+    # python Multinomial_NB_Classifier.py batch [workers]       label unlabeled IRTM docs with model.bin
+    # python Multinomial_NB_Classifier.py update [--reselect]    add new training.txt docs to model.bin
+    # python Multinomial_NB_Classifier.py cv [folds]             grid search selection method x feature count
+    # python Multinomial_NB_Classifier.py rocchio                train a rocchio model.bin from tf-idf vectors
+    # python Multinomial_NB_Classifier.py hashed [bits]          train a hashed NB model.bin, no vocabulary
+    if len(sys.argv) > 1 and sys.argv[1] == 'classify':
+        classify(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        training_data, all_label_doc = read_training('training.txt')
+        batch_classify(all_label_doc, int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count() or 1)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'rocchio':
+        rocchio_main()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'hashed':
+        hashed_main(int(sys.argv[2]) if len(sys.argv) > 2 else HASH_BITS)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'cv':
+        cross_validate(int(sys.argv[2]) if len(sys.argv) > 2 else CV_FOLDS, os.cpu_count() or 1)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'update':
+        update('--reselect' in sys.argv)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        serve(sys.argv[2] if len(sys.argv) > 2 else None)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'client':
+        texts = []
+        for path in sys.argv[2:]:
+            with open(path, 'r') as f:
+                texts.append(f.read())
+        for path, label in zip(sys.argv[2:], request_labels(texts)['labels']):
+            print(path, label)
+    else:
+        main()
 
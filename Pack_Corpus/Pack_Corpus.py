@@ -0,0 +1,38 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Common'))
+from corpus_io import PACK_SUFFIX, pack_corpus, open_corpus, doc_bytes, iter_docs
+
+
+CORPUS = 'IRTM'
+
+
+def verify(directory, pack):
+    # every packed document must match its source file byte for byte
+    corpus = open_corpus(directory)
+    if corpus['pack'] is None:
+        raise ValueError(pack + ' not found')
+    for doc_id, raw in iter_docs(corpus):
+        with open(os.path.join(directory, str(doc_id) + '.txt'), 'rb') as f:
+            if f.read() != raw:
+                print(f'document {doc_id} differs')
+                return False
+    print(f'{corpus["count"]} documents match')
+    return True
+
+
+if __name__ == '__main__':
+    # python Pack_Corpus.py [dir]             pack dir/<id>.txt (default IRTM) into dir.pack
+    # python Pack_Corpus.py verify [dir]      compare dir.pack with the files it was built from
+    # python Pack_Corpus.py show <id> [dir]   print one document from the pack
+    # the other scripts read IRTM.pack instead of IRTM/ whenever it sits next to them
+    if len(sys.argv) > 1 and sys.argv[1] == 'verify':
+        directory = sys.argv[2] if len(sys.argv) > 2 else CORPUS
+        sys.exit(0 if verify(directory, directory.rstrip('/') + PACK_SUFFIX) else 1)
+    elif len(sys.argv) > 2 and sys.argv[1] == 'show':
+        corpus = open_corpus(sys.argv[3] if len(sys.argv) > 3 else CORPUS)
+        sys.stdout.write(str(doc_bytes(corpus, int(sys.argv[2])), 'utf-8'))
+    else:
+        directory = sys.argv[1] if len(sys.argv) > 1 else CORPUS
+        count, size = pack_corpus(directory, directory.rstrip('/') + PACK_SUFFIX)
+        print(f'packed {count} documents, {size} bytes')
@@ -1,8 +1,22 @@
 import requests
 import re
+import os
 import sys
 import math
-from scipy import spatial
+import time
+import json
+import mmap
+import struct
+import hashlib
+import inspect
+import subprocess
+import numpy as np
+from multiprocessing import Pool
+from scipy import sparse
+from scipy.sparse import linalg as sparse_linalg
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Common'))
+from corpus_io import open_corpus, doc_bytes, load_token_cache, cached_tokens, save_token_cache
+from vectors import QUANT_MODES, vector_ids, read_vectors, quantize_vectors, save_quantized, dequantize, hash_counts
 
 # for Porter's stemmer algorithm
 class PorterStemmer:
@@ -319,82 +333,128 @@ class PorterStemmer:
 
 
 
+TOKEN_SPLIT = ' |\.|\'|\r|\n|\,|\?|\`|\(|\)|\-|\@|\"|\:|\_|\%|\#|\;|\/|\*|\$|\&|\!'
+MIN_TOKEN_LEN = 2
+try:
+    # changes whenever PorterStemmer is edited, so cached stems are never reused across versions
+    STEMMER_ID = hashlib.sha1(inspect.getsource(PorterStemmer).encode()).hexdigest()[:16]
+except (OSError, TypeError):
+    STEMMER_ID = 'porter-1' # no source to hash (.pyc only, exec'd code), a fixed id keys the cache instead
+CORPUS = 'IRTM'
+INDEX_PATH = 'index/'
+MANIFEST = 'manifest.json'
+SEGMENT = 'seg_'
+INDEX_LOCK = 'lock'
+MERGE_LOCK = 'merge.lock' # one merge at a time, so two merges never plan the same segments
+LOCK_TIMEOUT = 60 # seconds
+MAX_SEGMENTS = 8 # more than this many segments triggers a background merge
+MERGE_FACTOR = 4 # segments folded together by one merge at least
+VECTOR_PATH = 'vector/'
+KNN_FILE = 'knn.npz' # precomputed neighbor graph, next to vector/
+NEIGHBORS = 10
+NUM_PERM = 128 # minhash signature length
+MINHASH_PRIME = (1 << 31) - 1
+DUP_THRESHOLD = 0.8 # estimated jaccard of a near duplicate pair
+COSINE_THRESHOLD = 0.8 # tf-idf cosine a candidate needs with --verify
+LSI_FILE = 'lsi.npz' # reduced document vectors and projection, next to vector/
+LSI_DIM = 100
+HASH_BITS = 18 # hashed vectors have 2^HASH_BITS columns
+HASH_FILE = 'hashed.npz'
+HASH_CHUNK = 64 # documents per worker task
+MIN_DF = 1 # int: documents, float: share of the documents
+MAX_DF = 1.0
+MAX_FEATURES = 0 # keep only the top N terms by df, 0 keeps all
+QUANT_FILE = 'vector.q' # quantized copy of vector/
+POSITIONAL_FILE = 'positional.idx'
+POSITIONAL_MAGIC = b'POSINDEX'
+POSITIONAL_VERSION = 1
+TOKENIZER_FILE = 'tokenizer.json' # settings the vectors were built with, for the NB rocchio model
+KGRAM_FILE = 'kgram.npz' # k-gram index over the terms of dictionary.txt
+KGRAM = 3
+MIN_GRAM = 2 # grams from MIN_GRAM to KGRAM characters, shorter ones serve wildcard pieces below k
+FUZZY_DIST = 2
 
-def main():
-    stop_words = []
-    res = requests.get('http://ir.dcs.gla.ac.uk/resources/linguistic_utils/stop_words')
-    for word in res.text.split('\n'):
-        word = word.replace('\r','')
-        stop_words.append(word.lower())
+
+def main(min_df=MIN_DF, max_df=MAX_DF, max_features=MAX_FEATURES, positional=False):
+    stop_words = read_stop_words()
     p = PorterStemmer()
     count = 1
-    fileName = str(count) + '.txt'
     word_list = []
     output = []
     _id = 0
     term_in_art = []
-    while True:
+    positions = dict()
+    corpus = open_corpus(CORPUS)
+    cache = load_token_cache(corpus, tokenizer_settings(stop_words))
+    while count <= corpus['count']:
         try:
-            with open ('IRTM/' + fileName, 'r') as f :
-                df_num = False
-                temp = [] # record term id 
-                data = re.split(' |\.|\'|\r|\n|\,|\?|\`|\(|\)|\-|\@|\"|\:|\_|\%|\#|\;|\/|\*|\$|\&|\!', f.read())
-                for token in data :
-                    token = token.lower()
-                    if token is '' or len(token) < 2:
-                        continue
-                    if token in stop_words:
-                        continue
-                    if re.search(r'\d', token): # if token has number in it 
-                        continue
-                    stemmed_word = p.stem(token, 0,len(token)-1)
-                    if stemmed_word not in word_list:
-                        word_list.append(stemmed_word)
-                        output.append({'term': stemmed_word, 'df': 1 , 'all-tf':[{'id':count, 'tf':1}], 'id': _id})
-                        temp.append(_id)
-                        _id += 1
+            words = cached_tokens(cache, count, lambda text: tokenize(text, stop_words, p))
+            if positional:
+                add_positions(positions, count, words)
+            df_num = False
+            temp = [] # record term id 
+            for stemmed_word in words :
+                if stemmed_word not in word_list:
+                    word_list.append(stemmed_word)
+                    output.append({'term': stemmed_word, 'df': 1 , 'all-tf':[{'id':count, 'tf':1}], 'id': _id})
+                    temp.append(_id)
+                    _id += 1
+                    df_num = True
+                else:
+                    index = word_list.index(stemmed_word)
+                    flag = 0
+                    for data in output[index]['all-tf']:
+                        if data['id'] == count:
+                            data['tf'] +=1
+                            flag = 1
+                        break
+                    if not flag:
+                        output[index]['all-tf'].append({'id': count, 'tf':1})
+                    temp.append(output[index]['id'])
+                    # if output[index]['word'] != stemmed_word:
+                    #     print('error')
+                    #     break
+                    if not df_num:
+                        output[index]['df'] += 1
                         df_num = True
-                    else:
-                        index = word_list.index(stemmed_word)
-                        flag = 0
-                        for data in output[index]['all-tf']:
-                            if data['id'] == count:
-                                data['tf'] +=1
-                                flag = 1
-                            break
-                        if not flag:
-                            output[index]['all-tf'].append({'id': count, 'tf':1})
-                        temp.append(output[index]['id'])
-                        # if output[index]['word'] != stemmed_word:
-                        #     print('error')
-                        #     break
-                        if not df_num:
-                            output[index]['df'] += 1
-                            df_num = True
-                term_in_art.append(list(set(temp)))
+            term_in_art.append(list(set(temp)))
             print('finished' + ' '+str(count) + ' ' + 'document' )
             count += 1
-            fileName = str(count) + '.txt'
         except Exception as e:
             #print(e)
             print('finish')
             break
+    save_token_cache(cache)
+    if positional:
+        save_positional(POSITIONAL_FILE, positions, tokenizer_settings(stop_words))
+    # pruned terms get no index, the kept ones are numbered contiguously
+    kept = prune_terms(output, len(term_in_art), min_df, max_df, max_features)
+    if len(kept) < len(output):
+        prune_report(output, term_in_art, kept)
     mapping_to_index = dict()
     with open ('dictionary.txt', 'w') as f1:
         output_data = sorted(output,key=asending)
         f1.write('index' + ' '+'term ' + ' '+  'df' + '\n')
         index_from_one = 1
         for data in output_data:
+            if data['id'] not in kept:
+                continue
             mapping_to_index[data['id']] = index_from_one
             f1.write(str(index_from_one)+ ' ' + data['term'] + ' '+ str(data['df']) + '\n')
             index_from_one += 1
+    save_kgram(KGRAM_FILE, build_kgram(sorted(data['term'] for data in output if data['id'] in kept)))
+    save_tokenizer(TOKENIZER_FILE, tokenizer_settings(stop_words))
+    for name in os.listdir(VECTOR_PATH):
+        if name.endswith('.txt'):
+            os.remove(VECTOR_PATH + name) # an earlier export may have left ids past this corpus
     #2 
-    num_doc = 1095
+    num_doc = len(term_in_art)
     count = 1
     fileName = str(count) + '.txt'
-    all_doc = [[] for i in range(num_doc)] 
+    all_doc = [dict() for i in range(num_doc)]
     for art in term_in_art :
-        doc = [0 for i in range(len(output))]
+        art = [term_id for term_id in art if term_id in kept]
+        doc = dict() # sparse vector, term id -> tf-idf
         try:
             with open ( 'vector/' + fileName, 'w') as f :
                 f.write(str(len(art)) + '\n' + 't_index' + ' '  + 'tf-idf ' + '\n')
@@ -417,14 +477,1034 @@ def main():
             print('finish')
             break
     
-    cos_similarity(all_doc[0], all_doc[1])
+    if num_doc > 1:
+        cos_similarity(all_doc[0], all_doc[1])
     
     
  
 
 
+def tokenize(text, stop_words, p):
+    words = []
+    data = re.split(TOKEN_SPLIT, text)
+    for token in data :
+        token = token.lower()
+        if token == '' or len(token) < MIN_TOKEN_LEN:
+            continue
+        if token in stop_words:
+            continue
+        if re.search(r'\d', token): # if token has number in it 
+            continue
+        words.append(p.stem(token, 0,len(token)-1))
+    return words
+
+
+def tokenizer_settings(stop_words):
+    return {'split': TOKEN_SPLIT, 'min_len': MIN_TOKEN_LEN, 'stop_words': sorted(stop_words), 'stemmer': STEMMER_ID}
+
+
+def df_limit(value, num_doc):
+    # an int is a document count, a float a share of the documents
+    return value * num_doc if isinstance(value, float) else value
+
+
+def prune_terms(output, num_doc, min_df, max_df, max_features):
+    # ids of the terms with min_df <= df <= max_df, then the max_features most frequent of them
+    low = df_limit(min_df, num_doc)
+    high = df_limit(max_df, num_doc)
+    kept = [data for data in output if low <= data['df'] <= high]
+    if max_features:
+        kept = sorted(kept, key=lambda d: (-d['df'], d['term']))[:max_features]
+    return set(data['id'] for data in kept)
+
+
+def prune_report(output, term_in_art, kept):
+    # width, CSR memory and the all pairs cosine (what HAC and neighbors pay) before and after,
+    # on binary tf x idf rows since only the sparsity pattern matters for the cost
+    num_doc = len(term_in_art)
+    idf = np.array([math.log(num_doc / data['df'], 10) for data in output])
+    remap = np.full(len(output), -1)
+    remap[sorted(kept)] = np.arange(len(kept))
+    for name, width, keep in [('before', len(output), None), ('after', len(kept), remap)]:
+        indptr = [0]
+        indices = []
+        for art in term_in_art:
+            cols = np.array(art, dtype=np.int64)
+            if keep is not None:
+                cols = keep[cols]
+                cols = cols[cols >= 0]
+            indices += cols.tolist()
+            indptr.append(len(indices))
+        indices = np.array(indices, dtype=np.int32)
+        weight = idf[indices] if keep is None else idf[np.array(sorted(kept))[indices]]
+        X = sparse.csr_matrix((weight, indices, np.array(indptr, dtype=np.int32)), shape=(num_doc, width))
+        norm = np.sqrt(np.asarray(X.multiply(X).sum(axis=1)).ravel())
+        norm[norm == 0] = 1
+        X = sparse.csr_matrix(sparse.diags(1 / norm) @ X)
+        start = time.time()
+        X @ X.T
+        elapsed = time.time() - start
+        memory = X.data.nbytes + X.indices.nbytes + X.indptr.nbytes
+        print(f'{name} pruning: {width} terms, {X.nnz} nonzeros, {memory} bytes, all pairs cosine {elapsed:.4f}s')
+
+
+def save_tokenizer(name, settings):
+    with open(name + '.tmp', 'w') as f:
+        json.dump(settings, f)
+    os.replace(name + '.tmp', name)
+
+
+def read_stop_words():
+    stop_words = []
+    res = requests.get('http://ir.dcs.gla.ac.uk/resources/linguistic_utils/stop_words')
+    for word in res.text.split('\n'):
+        word = word.replace('\r','')
+        stop_words.append(word.lower())
+    return stop_words
+
+
+def load_manifest(path):
+    # term table in id order (append only), df per term id, and per segment its doc ids and deletions
+    try:
+        with open(os.path.join(path, MANIFEST), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'terms': [], 'df': [], 'segments': dict(), 'next': 0}
+
+
+def save_manifest(path, manifest):
+    with open(os.path.join(path, MANIFEST + '.tmp'), 'w') as f:
+        json.dump(manifest, f)
+    os.replace(os.path.join(path, MANIFEST + '.tmp'), os.path.join(path, MANIFEST))
+
+
+def lock_index(path):
+    # one writer at a time, a lock left behind by a crash has to be removed by hand.
+    # readers take it too, a merge deletes the segments it folded only while holding it
+    os.makedirs(path, exist_ok=True)
+    start = time.time()
+    while True:
+        try:
+            os.close(os.open(os.path.join(path, INDEX_LOCK), os.O_CREAT | os.O_EXCL))
+            return
+        except FileExistsError:
+            if time.time() - start > LOCK_TIMEOUT:
+                raise TimeoutError(os.path.join(path, INDEX_LOCK) + ' is held, remove it if no indexer is running')
+            time.sleep(0.05)
+
+
+def unlock_index(path):
+    os.remove(os.path.join(path, INDEX_LOCK))
+
+
+def write_segment(path, name, doc_ids, doc_tf):
+    # raw term frequencies only, the weights depend on the global df and are computed when read
+    indptr = [0]
+    terms = []
+    tf = []
+    for counts in doc_tf:
+        for term_id in sorted(counts):
+            terms.append(term_id)
+            tf.append(counts[term_id])
+        indptr.append(len(terms))
+    with open(os.path.join(path, name + '.tmp'), 'wb') as f:
+        np.savez(f, doc_ids=np.array(doc_ids, dtype=np.int64), indptr=np.array(indptr, dtype=np.int64),
+                 terms=np.array(terms, dtype=np.int64), tf=np.array(tf, dtype=np.int64))
+    os.replace(os.path.join(path, name + '.tmp'), os.path.join(path, name))
+
+
+def read_segment(path, name):
+    with np.load(os.path.join(path, name)) as data:
+        segment = {key: data[key] for key in data.files}
+    segment['row'] = {int(doc_id): n for n, doc_id in enumerate(segment['doc_ids'])}
+    return segment
+
+
+def segment_tf(segment, row):
+    start, end = segment['indptr'][row], segment['indptr'][row + 1]
+    return segment['terms'][start:end], segment['tf'][start:end]
+
+
+def live_docs(manifest):
+    # doc id -> segment holding its current version
+    docs = dict()
+    for name, info in manifest['segments'].items():
+        deleted = set(info['deleted'])
+        for doc_id in info['docs']:
+            if doc_id not in deleted:
+                docs[doc_id] = name
+    return docs
+
+
+def drop_docs(path, manifest, doc_ids):
+    # mark documents deleted in their segment and take their terms out of df
+    docs = live_docs(manifest)
+    segments = dict()
+    removed = 0
+    for doc_id in doc_ids:
+        name = docs.get(doc_id)
+        if name is None:
+            continue
+        if name not in segments:
+            segments[name] = read_segment(path, name)
+        terms, tf = segment_tf(segments[name], segments[name]['row'][doc_id])
+        for term_id in terms:
+            manifest['df'][term_id] -= 1
+        manifest['segments'][name]['deleted'].append(doc_id)
+        removed += 1
+    return removed
+
+
+def add_documents(path, doc_ids):
+    # tokenize the documents into a new delta segment and update df, an already indexed
+    # document is replaced by its new version
+    doc_ids = list(dict.fromkeys(doc_ids)) # a repeated id would count its terms twice in df
+    stop_words = read_stop_words()
+    p = PorterStemmer()
+    corpus = open_corpus(CORPUS)
+    cache = load_token_cache(corpus, tokenizer_settings(stop_words))
+    words = [cached_tokens(cache, doc_id, lambda text: tokenize(text, stop_words, p)) for doc_id in doc_ids]
+    save_token_cache(cache)
+    lock_index(path)
+    try:
+        manifest = load_manifest(path)
+        drop_docs(path, manifest, doc_ids)
+        term_id = {term: n for n, term in enumerate(manifest['terms'])}
+        doc_tf = []
+        for doc_words in words:
+            counts = dict()
+            for word in doc_words:
+                if word not in term_id:
+                    term_id[word] = len(manifest['terms'])
+                    manifest['terms'].append(word)
+                    manifest['df'].append(0)
+                counts[term_id[word]] = counts.get(term_id[word], 0) + 1
+            for n in counts:
+                manifest['df'][n] += 1
+            doc_tf.append(counts)
+        name = SEGMENT + str(manifest['next'])
+        manifest['next'] += 1
+        write_segment(path, name, doc_ids, doc_tf)
+        manifest['segments'][name] = {'docs': list(doc_ids), 'deleted': []}
+        save_manifest(path, manifest)
+    finally:
+        unlock_index(path)
+    print(f'indexed {len(doc_ids)} documents into {name}')
+    schedule_merge(path, manifest)
+
+
+def remove_documents(path, doc_ids):
+    lock_index(path)
+    try:
+        manifest = load_manifest(path)
+        removed = drop_docs(path, manifest, doc_ids)
+        save_manifest(path, manifest)
+    finally:
+        unlock_index(path)
+    print(f'removed {removed} documents')
+    schedule_merge(path, manifest)
+
+
+def merge_plan(manifest, merge_all=False):
+    # the smallest segments by live documents are merged once there are too many of them,
+    # so a lookup never has to open more than MAX_SEGMENTS files
+    size = lambda name: len(manifest['segments'][name]['docs']) - len(manifest['segments'][name]['deleted'])
+    names = sorted(manifest['segments'], key=size)
+    if merge_all:
+        return names if len(names) > 1 or any(manifest['segments'][n]['deleted'] for n in names) else []
+    if len(names) <= MAX_SEGMENTS:
+        return []
+    return names[:max(MERGE_FACTOR, len(names) - MAX_SEGMENTS + 1)]
+
+
+def schedule_merge(path, manifest):
+    # merging runs in a detached process, the indexer returns right away
+    if merge_plan(manifest):
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), 'merge'], start_new_session=True)
+
+
+def merge_segments(path, merge_all=False):
+    # a merge that finds another one running leaves the work to it, the running merge
+    # plans again when it is done and picks up whatever was added meanwhile
+    try:
+        os.close(os.open(os.path.join(path, MERGE_LOCK), os.O_CREAT | os.O_EXCL))
+    except FileExistsError:
+        print('a merge is already running')
+        return
+    try:
+        while merge_once(path, merge_all):
+            pass
+    finally:
+        os.remove(os.path.join(path, MERGE_LOCK))
+
+
+def merge_once(path, merge_all):
+    lock_index(path)
+    try:
+        manifest = load_manifest(path)
+        names = merge_plan(manifest, merge_all)
+        if not names:
+            return False
+        snapshot = {name: set(manifest['segments'][name]['deleted']) for name in names}
+        name = SEGMENT + str(manifest['next'])
+        manifest['next'] += 1
+        save_manifest(path, manifest)
+    finally:
+        unlock_index(path)
+    # the copy runs without the lock, adds and removes can go on meanwhile
+    doc_ids = []
+    doc_tf = []
+    for old in names:
+        segment = read_segment(path, old)
+        for doc_id, row in segment['row'].items():
+            if doc_id in snapshot[old]:
+                continue
+            terms, tf = segment_tf(segment, row)
+            doc_ids.append(doc_id)
+            doc_tf.append(dict(zip(terms.tolist(), tf.tolist())))
+    write_segment(path, name, doc_ids, doc_tf)
+    lock_index(path)
+    try:
+        manifest = load_manifest(path)
+        # documents deleted while merging stay deleted in the merged segment
+        deleted = []
+        for old in names:
+            deleted += [doc_id for doc_id in manifest['segments'][old]['deleted'] if doc_id not in snapshot[old]]
+            del manifest['segments'][old]
+        manifest['segments'][name] = {'docs': doc_ids, 'deleted': deleted}
+        save_manifest(path, manifest)
+        for old in names:
+            os.remove(os.path.join(path, old))
+    finally:
+        unlock_index(path)
+    print(f'merged {len(names)} segments into {name}')
+    return True
+
+
+def index_vectors(path):
+    # tf-idf of every live document from the stored tf and the current df:
+    # doc id -> {term id: tf * log10(N / df)}
+    lock_index(path)
+    try:
+        manifest = load_manifest(path)
+        segments = {name: read_segment(path, name) for name in manifest['segments']}
+    finally:
+        unlock_index(path)
+    docs = live_docs(manifest)
+    num_doc = len(docs)
+    idf = np.zeros(len(manifest['df']))
+    df = np.array(manifest['df'], dtype=float)
+    idf[df > 0] = np.log10(num_doc / df[df > 0])
+    vectors = dict()
+    for name, segment in segments.items():
+        for doc_id, row in segment['row'].items():
+            if docs.get(doc_id) != name:
+                continue
+            terms, tf = segment_tf(segment, row)
+            vectors[doc_id] = dict(zip(terms.tolist(), (tf * idf[terms]).tolist()))
+    return manifest, vectors
+
+
+def export_index(path):
+    # dictionary.txt, vector/<doc id>.txt and kgram.npz in the same format main() writes,
+    # removed documents leave a gap in the vector ids
+    manifest, vectors = index_vectors(path)
+    order = sorted((term, n) for n, term in enumerate(manifest['terms']) if manifest['df'][n] > 0)
+    mapping_to_index = dict()
+    with open ('dictionary.txt', 'w') as f1:
+        f1.write('index' + ' '+'term ' + ' '+  'df' + '\n')
+        for index_from_one, (term, n) in enumerate(order, 1):
+            mapping_to_index[n] = index_from_one
+            f1.write(str(index_from_one)+ ' ' + term + ' '+ str(manifest['df'][n]) + '\n')
+    os.makedirs(VECTOR_PATH, exist_ok=True)
+    for name in os.listdir(VECTOR_PATH):
+        if name.endswith('.txt'):
+            os.remove(VECTOR_PATH + name) # vectors of deleted documents or of an earlier, larger run
+    for doc_id, vec in vectors.items():
+        with open (VECTOR_PATH + str(doc_id) + '.txt', 'w') as f:
+            f.write(str(len(vec)) + '\n' + 't_index' + ' '  + 'tf-idf ' + '\n')
+            for term_id in sorted(vec, key=lambda n: mapping_to_index[n]):
+                f.write(str(mapping_to_index[term_id])+ ' ' + str(vec[term_id])  + '\n')
+    save_kgram(KGRAM_FILE, build_kgram([term for term, n in order]))
+    save_tokenizer(TOKENIZER_FILE, tokenizer_settings(read_stop_words()))
+    print(f'exported {len(vectors)} documents, {len(order)} terms')
+
+
+def print_vector(path, doc_id):
+    lock_index(path)
+    try:
+        manifest = load_manifest(path)
+        name = live_docs(manifest).get(doc_id)
+        segment = read_segment(path, name) if name is not None else None
+    finally:
+        unlock_index(path)
+    if name is None:
+        print(f'document {doc_id} is not indexed')
+        return
+    num_doc = len(live_docs(manifest))
+    terms, tf = segment_tf(segment, segment['row'][doc_id])
+    for term_id, count in zip(terms.tolist(), tf.tolist()):
+        print(manifest['terms'][term_id], count * math.log(num_doc / manifest['df'][term_id], 10))
+
+
+def top_k(scores, k, exclude):
+    # argpartition for the k best, then only those k are sorted
+    scores[exclude] = -np.inf
+    k = min(k, int(np.count_nonzero(scores > 0)))
+    if k == 0:
+        return np.zeros(0, dtype=np.int64)
+    best = np.argpartition(-scores, k - 1)[:k]
+    return best[np.argsort(-scores[best], kind='stable')]
+
+
+def doc_row(doc_ids, doc_id):
+    # row of a document in the sorted ids of read_vectors
+    row = int(np.searchsorted(doc_ids, doc_id))
+    if row == len(doc_ids) or doc_ids[row] != doc_id:
+        raise ValueError(f'document {doc_id} has no vector')
+    return row
+
+
+def neighbors(X, inverted, doc_ids, doc_id, k):
+    # walk only the postings of the query document's terms, every other document scores 0
+    row = doc_row(doc_ids, doc_id)
+    scores = np.zeros(X.shape[0])
+    for t, weight in zip(X.indices[X.indptr[row]:X.indptr[row + 1]], X.data[X.indptr[row]:X.indptr[row + 1]]):
+        start, end = inverted.indptr[t], inverted.indptr[t + 1]
+        scores[inverted.indices[start:end]] += weight * inverted.data[start:end]
+    best = top_k(scores, k, row)
+    return [(int(doc_ids[n]), float(scores[n])) for n in best]
+
+
+def knn_graph(X, doc_ids, k, block=256):
+    # top-k neighbors of every document, a block of rows against all documents at a time
+    num_doc = X.shape[0]
+    ids = np.zeros((num_doc, k), dtype=np.int32)
+    sims = np.zeros((num_doc, k), dtype=np.float32)
+    XT = X.T.tocsc()
+    for start in range(0, num_doc, block):
+        S = (X[start:start + block] @ XT).toarray()
+        for n, scores in enumerate(S):
+            best = top_k(scores, k, start + n)
+            ids[start + n, :len(best)] = doc_ids[best] # 0 pads rows with fewer than k neighbors
+            sims[start + n, :len(best)] = scores[best]
+    return ids, sims
+
+
+def vector_fingerprint(X, doc_ids):
+    # shape, nnz and a checksum of the ids and CSR arrays, changes whenever any vector does
+    h = hashlib.sha1(np.array(X.shape + (X.nnz,), dtype=np.int64).tobytes())
+    for part in (np.asarray(doc_ids, dtype=np.int64), X.indptr, X.indices, X.data):
+        h.update(np.ascontiguousarray(part).tobytes())
+    return h.hexdigest()
+
+
+def save_knn(name, ids, sims, X, doc_ids):
+    with open(name + '.tmp', 'wb') as f:
+        np.savez(f, ids=ids, sims=sims, num_doc=np.int64(X.shape[0]), fingerprint=np.array(vector_fingerprint(X, doc_ids)))
+    os.replace(name + '.tmp', name)
+
+
+def load_knn(name, X, doc_ids, k):
+    # the stored graph answers a query only when it was built from exactly these vectors
+    # with at least k neighbors, a rebuilt vector/ of the same size does not pass
+    if not os.path.exists(name):
+        return None
+    with np.load(name) as data:
+        if 'fingerprint' not in data.files or str(data['fingerprint']) != vector_fingerprint(X, doc_ids):
+            return None
+        if int(data['num_doc']) != X.shape[0] or data['ids'].shape[1] < k:
+            return None
+        return data['ids'], data['sims']
+
+
+def more_like_this(doc_id, k):
+    doc_ids, X = read_vectors(VECTOR_PATH)
+    graph = load_knn(KNN_FILE, X, doc_ids, k)
+    if graph is not None:
+        ids, sims = graph
+        row = doc_row(doc_ids, doc_id)
+        result = [(int(n), float(s)) for n, s in zip(ids[row, :k], sims[row, :k]) if n]
+    else:
+        result = neighbors(X, X.tocsc(), doc_ids, doc_id, k)
+    for n, score in result:
+        print(n, score)
+    return result
+
+
+def term_sets():
+    # the term_in_art sets of main(): every document's distinct term ids
+    stop_words = read_stop_words()
+    p = PorterStemmer()
+    corpus = open_corpus(CORPUS)
+    cache = load_token_cache(corpus, tokenizer_settings(stop_words))
+    term_id = dict()
+    term_in_art = []
+    for count in range(1, corpus['count'] + 1):
+        words = cached_tokens(cache, count, lambda text: tokenize(text, stop_words, p))
+        term_in_art.append(np.array(sorted({term_id.setdefault(word, len(term_id)) for word in words}), dtype=np.int64))
+    save_token_cache(cache)
+    return term_in_art
+
+
+def minhash(term_in_art, num_perm, seed=0):
+    # h(x) = (a * x + b) mod p for num_perm random (a, b), the signature keeps each minimum
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, MINHASH_PRIME, num_perm, dtype=np.int64)
+    b = rng.integers(0, MINHASH_PRIME, num_perm, dtype=np.int64)
+    sig = np.full((len(term_in_art), num_perm), MINHASH_PRIME, dtype=np.int64)
+    for n, terms in enumerate(term_in_art):
+        if len(terms):
+            sig[n] = ((a[:, None] * terms[None, :] + b[:, None]) % MINHASH_PRIME).min(axis=1)
+    return sig
+
+
+def choose_bands(num_perm, threshold):
+    # b bands of r rows put the 50% candidate point near (1 / b) ** (1 / r)
+    options = [(num_perm // r, r) for r in range(1, num_perm + 1) if num_perm % r == 0]
+    return min(options, key=lambda d: abs((1 / d[0]) ** (1 / d[1]) - threshold))
+
+
+def lsh_candidates(sig, bands, rows):
+    # documents agreeing on every row of some band share a bucket and become a candidate pair
+    pairs = set()
+    for band in range(bands):
+        buckets = dict()
+        for n, key in enumerate(sig[:, band * rows:(band + 1) * rows]):
+            buckets.setdefault(key.tobytes(), []).append(n)
+        for docs in buckets.values():
+            for i in range(len(docs)):
+                for j in range(i + 1, len(docs)):
+                    pairs.add((docs[i], docs[j]))
+    return sorted(pairs)
+
+
+def near_duplicates(threshold, verify=False):
+    term_in_art = term_sets()
+    sig = minhash(term_in_art, NUM_PERM)
+    bands, rows = choose_bands(NUM_PERM, threshold)
+    candidates = lsh_candidates(sig, bands, rows)
+    if verify:
+        doc_ids, X = read_vectors(VECTOR_PATH)
+        if len(doc_ids) and doc_ids[-1] > len(term_in_art):
+            raise ValueError(f'{VECTOR_PATH} has document {doc_ids[-1]}, the corpus {len(term_in_art)}: rebuild the vectors first')
+        row = {int(doc_id): n for n, doc_id in enumerate(doc_ids)}
+    result = []
+    for i, j in candidates:
+        jaccard = float(np.mean(sig[i] == sig[j]))
+        if jaccard < threshold:
+            continue
+        if verify:
+            if i + 1 not in row or j + 1 not in row:
+                continue # removed from the exported index
+            cos = float(X[row[i + 1]].multiply(X[row[j + 1]]).sum())
+            if cos < COSINE_THRESHOLD:
+                continue
+            result.append((i + 1, j + 1, jaccard, cos))
+        else:
+            result.append((i + 1, j + 1, jaccard))
+    print(f'{len(term_in_art)} documents, {bands} bands x {rows} rows, {len(candidates)} candidates, {len(result)} duplicates')
+    for val in result:
+        print(*val)
+    return result
+
+
+def build_lsi(X, k):
+    # truncated SVD X ~ U S V^T of the normalized document-term matrix, documents are
+    # stored as X V = U S and V is the projection new vectors are folded in with
+    k = min(k, min(X.shape) - 1)
+    u, s, vt = sparse_linalg.svds(X, k=k)
+    order = np.argsort(-s)
+    return {'docs': (u[:, order] * s[order]).astype(np.float32), 'proj': vt[order].T.astype(np.float32),
+            'sigma': s[order].astype(np.float32)}
+
+
+def save_lsi(name, lsi):
+    with open(name + '.tmp', 'wb') as f:
+        np.savez(f, **lsi)
+    os.replace(name + '.tmp', name)
+
+
+def load_lsi(name):
+    with np.load(name) as data:
+        lsi = {key: data[key] for key in data.files}
+    if 'doc_ids' not in lsi:
+        lsi['doc_ids'] = np.arange(1, len(lsi['docs']) + 1) # saved before the ids were stored
+    return lsi
+
+
+def fold_in(X, lsi):
+    # rows of the same tf-idf term space as vector/ mapped into the lsi space
+    return np.asarray(X @ lsi['proj'], dtype=np.float32)
+
+
+def unit_rows(D):
+    norm = np.linalg.norm(D, axis=1)
+    norm[norm == 0] = 1
+    return D / norm[:, None]
+
+
+def query_vector(text, num_term):
+    # a query as a normalized tf-idf row, with the df of dictionary.txt and the stop words of main()
+    stop_words = read_stop_words()
+    p = PorterStemmer()
+    index = dict()
+    with open('dictionary.txt', 'r') as f:
+        for line in f.readlines()[1:]:
+            t_index, term, df = line.split()
+            index[term] = (int(t_index) - 1, int(df))
+    num_doc = len(vector_ids(VECTOR_PATH))
+    tf = dict()
+    for word in tokenize(text, stop_words, p):
+        if word in index:
+            tf[word] = tf.get(word, 0) + 1
+    q = np.zeros(num_term)
+    for word, count in tf.items():
+        t_index, df = index[word]
+        if t_index < num_term:
+            q[t_index] = count * math.log(num_doc / df, 10)
+    norm = np.linalg.norm(q)
+    return sparse.csr_matrix(q / norm if norm else q)
+
+
+def lsi_neighbors(D, doc_ids, doc_id, k):
+    # D holds unit length rows, one dense product scores every document
+    row = doc_row(doc_ids, doc_id)
+    scores = D @ D[row]
+    scores[row] = -np.inf
+    k = min(k, len(scores) - 1)
+    best = np.argpartition(-scores, k - 1)[:k]
+    best = best[np.argsort(-scores[best], kind='stable')]
+    return [(int(doc_ids[n]), float(scores[n])) for n in best]
+
+
+def lsi_query(text, k):
+    _, X = read_vectors(VECTOR_PATH)
+    lsi = load_lsi(LSI_FILE)
+    q = unit_rows(fold_in(query_vector(text, X.shape[1]), lsi))[0]
+    scores = unit_rows(lsi['docs']) @ q
+    best = np.argsort(-scores, kind='stable')[:k]
+    for n in best:
+        print(int(lsi['doc_ids'][n]), float(scores[n]))
+
+
+def lsi_report(k, top=NEIGHBORS):
+    # timing of the all pairs cosine and how well the lsi neighbors agree with full tf-idf
+    _, X = read_vectors(VECTOR_PATH)
+    start = time.time()
+    lsi = build_lsi(X, k)
+    svd_time = time.time() - start
+    start = time.time()
+    S = (X @ X.T).toarray()
+    full_time = time.time() - start
+    D = unit_rows(lsi['docs'])
+    start = time.time()
+    L = D @ D.T
+    lsi_time = time.time() - start
+    num_doc = X.shape[0]
+    np.fill_diagonal(S, -np.inf)
+    np.fill_diagonal(L, -np.inf)
+    overlap = 0
+    for n in range(num_doc):
+        full = set(np.argpartition(-S[n], top - 1)[:top].tolist())
+        low = set(np.argpartition(-L[n], top - 1)[:top].tolist())
+        overlap += len(full & low) / top
+    upper = np.triu_indices(num_doc, 1)
+    corr = float(np.corrcoef(S[upper], L[upper])[0, 1])
+    energy = float((lsi['sigma'].astype(float) ** 2).sum() / X.multiply(X).sum())
+    print(f'{num_doc} documents, {X.shape[1]} terms -> {lsi["docs"].shape[1]} dimensions (svd {svd_time:.3f}s)')
+    print(f'all pairs cosine: tf-idf {full_time:.4f}s, lsi {lsi_time:.4f}s')
+    print(f'memory: tf-idf {X.data.nbytes + X.indices.nbytes + X.indptr.nbytes} bytes, lsi {lsi["docs"].nbytes} bytes')
+    print(f'variance kept {energy:.3f}, pairwise cosine correlation {corr:.3f}, top-{top} neighbor overlap {overlap / num_doc:.3f}')
+
+
+_worker = dict()
+
+def init_hash_worker(stop_words, bits):
+    _worker['stop_words'] = set(stop_words)
+    _worker['p'] = PorterStemmer()
+    _worker['corpus'] = open_corpus(CORPUS)
+    _worker['bits'] = bits
+
+
+def hash_chunk(doc_ids):
+    # tokenize straight from the corpus, a worker keeps nothing between chunks
+    docs = [tokenize(str(doc_bytes(_worker['corpus'], doc_id), 'utf-8'), _worker['stop_words'], _worker['p']) for doc_id in doc_ids]
+    return hash_counts(docs, _worker['bits'])
+
+
+def hash_vectors(bits, workers):
+    # one streaming pass over the corpus, no dictionary: signed tf of 2^bits hashed features
+    count = open_corpus(CORPUS)['count']
+    chunks = [list(range(n, min(n + HASH_CHUNK, count + 1))) for n in range(1, count + 1, HASH_CHUNK)]
+    with Pool(workers, initializer=init_hash_worker, initargs=(read_stop_words(), bits)) as pool:
+        blocks = pool.map(hash_chunk, chunks)
+    return sparse.vstack(blocks, format='csr') if blocks else sparse.csr_matrix((0, 1 << bits))
+
+
+def read_hashed(name):
+    # tf * log10(N / df) with df counted per hashed column, rows L2 normalized
+    X = sparse.load_npz(name).tocsr()
+    df = np.bincount(X.indices, minlength=X.shape[1])
+    idf = np.zeros(X.shape[1])
+    idf[df > 0] = np.log10(X.shape[0] / df[df > 0])
+    X = X.multiply(idf[None, :]).tocsr()
+    norm = np.sqrt(np.asarray(X.multiply(X).sum(axis=1)).ravel())
+    norm[norm == 0] = 1
+    return sparse.csr_matrix(sparse.diags(1 / norm) @ X)
+
+
+def quantize_report(top=NEIGHBORS):
+    # how far the cosines and the top neighbors of each document move, for both modes
+    _, X = read_vectors(VECTOR_PATH)
+    S = (X @ X.T).toarray()
+    num_doc = X.shape[0]
+    upper = np.triu_indices(num_doc, 1)
+    full_rank = np.argsort(-np.where(np.eye(num_doc, dtype=bool), -np.inf, S), axis=1, kind='stable')[:, :top]
+    print(f'float64: {X.data.nbytes} bytes of weights, similarity matrix {S[upper].astype(np.float64).nbytes} bytes')
+    for mode in QUANT_MODES:
+        q = quantize_vectors(X, mode)
+        Xq = dequantize(q)
+        Sq = (Xq @ Xq.T).toarray().astype(np.float64)
+        rank = np.argsort(-np.where(np.eye(num_doc, dtype=bool), -np.inf, Sq), axis=1, kind='stable')[:, :top]
+        overlap = np.mean([len(set(full_rank[n]) & set(rank[n])) / top for n in range(num_doc)])
+        same_first = np.mean(full_rank[:, 0] == rank[:, 0])
+        err = np.abs(Sq - S)[upper]
+        weight_bytes = q['data'].nbytes + (q['scale'].nbytes if mode == 'int8' else 0)
+        print(f'{mode}: {weight_bytes} bytes of weights, cosine error mean {err.mean():.2e} max {err.max():.2e}, '
+              f'top-{top} overlap {overlap:.4f}, same nearest neighbor {same_first:.4f}')
+    S16 = S[upper].astype(np.float16)
+    err = np.abs(S16.astype(np.float64) - S[upper])
+    print(f'float16 similarity matrix: {S16.nbytes} bytes, error mean {err.mean():.2e} max {err.max():.2e}')
+
+
+def add_positions(positions, doc_id, words):
+    # term -> [(doc id, [positions])], a position counts the stemmed tokens kept before it
+    seen = dict()
+    for pos, word in enumerate(words):
+        if word not in seen:
+            seen[word] = []
+            positions.setdefault(word, []).append((doc_id, seen[word]))
+        seen[word].append(pos)
+
+
+def encode_varints(values, out):
+    # 7 bits per byte, the high bit marks that another byte follows
+    for value in values:
+        while value >= 0x80:
+            out.append((value & 0x7f) | 0x80)
+            value >>= 7
+        out.append(value)
+
+
+def decode_varints(buf, start, count):
+    values = []
+    pos = start
+    for n in range(count):
+        value = 0
+        shift = 0
+        while True:
+            byte = buf[pos]
+            pos += 1
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        values.append(value)
+    return values, pos
+
+
+def save_positional(name, positions, settings):
+    # JSON header (tokenizer settings, term -> [offset, length, df]) and one varint block per
+    # term: for each document the doc id gap, the position count and the position gaps
+    blob = bytearray()
+    terms = dict()
+    for term in sorted(positions):
+        start = len(blob)
+        last_doc = 0
+        for doc_id, pos_list in positions[term]:
+            encode_varints([doc_id - last_doc, len(pos_list)], blob)
+            encode_varints([pos_list[0]] + [b - a for a, b in zip(pos_list, pos_list[1:])], blob)
+            last_doc = doc_id
+        terms[term] = [start, len(blob) - start, len(positions[term])]
+    header = json.dumps({'tokenizer': settings, 'terms': terms}).encode('utf-8')
+    with open(name + '.tmp', 'wb') as f:
+        f.write(POSITIONAL_MAGIC)
+        f.write(struct.pack('<II', POSITIONAL_VERSION, len(header)))
+        f.write(header)
+        f.write(blob)
+    os.replace(name + '.tmp', name)
+
+
+def load_positional(name):
+    with open(name, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if data[:len(POSITIONAL_MAGIC)] != POSITIONAL_MAGIC:
+        raise ValueError(name + ' is not a positional index')
+    version, header_len = struct.unpack_from('<II', data, len(POSITIONAL_MAGIC))
+    if version != POSITIONAL_VERSION:
+        raise ValueError(f'{name}: unsupported version {version}')
+    start = len(POSITIONAL_MAGIC) + 8
+    header = json.loads(data[start:start + header_len].decode('utf-8'))
+    return {'data': data, 'base': start + header_len, 'terms': header['terms'], 'tokenizer': header['tokenizer']}
+
+
+def postings(index, term):
+    # doc id -> positions of one term, only its own block is decoded
+    if term not in index['terms']:
+        return dict()
+    offset, length, df = index['terms'][term]
+    pos = index['base'] + offset
+    result = dict()
+    doc_id = 0
+    for n in range(df):
+        (gap, count), pos = decode_varints(index['data'], pos, 2)
+        gaps, pos = decode_varints(index['data'], pos, count)
+        doc_id += gap
+        result[doc_id] = np.cumsum(gaps).tolist()
+    return result
+
+
+def query_terms(index, text):
+    settings = index['tokenizer']
+    return tokenize(text, set(settings['stop_words']), PorterStemmer())
+
+
+def rarest_first(index, words):
+    # (offset in the query, postings) with the smallest df first, so the candidate set
+    # starts as small as it can get and only shrinks
+    order = sorted(range(len(words)), key=lambda n: index['terms'].get(words[n], [0, 0, 0])[2])
+    lists = []
+    docs = None
+    for n in order:
+        plist = postings(index, words[n])
+        docs = set(plist) if docs is None else docs.intersection(plist)
+        if not docs:
+            return [], set()
+        lists.append((n, plist))
+    return lists, docs
+
+
+def phrase_query(index, text):
+    # documents holding the query terms at consecutive positions
+    words = query_terms(index, text)
+    if not words:
+        return []
+    lists, docs = rarest_first(index, words)
+    result = []
+    for doc_id in sorted(docs):
+        first, plist = lists[0]
+        starts = set(p - first for p in plist[doc_id])
+        for n, other in lists[1:]:
+            starts.intersection_update(p - n for p in other[doc_id])
+            if not starts:
+                break
+        if starts:
+            result.append((doc_id, sorted(starts)))
+    return result
+
+
+def proximity_query(index, text, k):
+    # documents where all query terms fall inside a window of at most k + 1 tokens
+    words = list(dict.fromkeys(query_terms(index, text)))
+    if not words:
+        return []
+    lists, docs = rarest_first(index, words)
+    result = []
+    for doc_id in sorted(docs):
+        merged = sorted((p, n) for n, (offset, plist) in enumerate(lists) for p in plist[doc_id])
+        # smallest window covering every term, two pointers over the merged positions
+        count = dict()
+        best = None
+        left = 0
+        for right in range(len(merged)):
+            count[merged[right][1]] = count.get(merged[right][1], 0) + 1
+            while len(count) == len(lists):
+                span = merged[right][0] - merged[left][0]
+                if best is None or span < best:
+                    best = span
+                count[merged[left][1]] -= 1
+                if count[merged[left][1]] == 0:
+                    del count[merged[left][1]]
+                left += 1
+        if best is not None and best <= k:
+            result.append((doc_id, best))
+    return result
+
+
+def term_grams(term, k):
+    # k-grams of the term padded with $ at both ends, so prefixes and suffixes get their own grams
+    padded = '$' + term + '$'
+    return set(padded[n:n + k] for n in range(len(padded) - k + 1))
+
+
+def deletions(term, d):
+    # every string left after deleting at most d characters of the term
+    variants = {term}
+    frontier = {term}
+    for _ in range(d):
+        frontier = {v[:n] + v[n + 1:] for v in frontier for n in range(len(v))}
+        variants |= frontier
+    return variants
+
+
+def deletion_key(variant):
+    # stable across processes, a collision only adds a candidate that the edit distance rejects
+    return int.from_bytes(hashlib.blake2b(variant.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def build_deletions(terms, k, d):
+    # deletion neighbourhood of the short terms, where the gram count bound prunes nothing:
+    # a term within distance d of the query shares a variant with at most d deletions.
+    # a query short enough to need it matches terms of at most k * d + d characters
+    keys = []
+    ids = []
+    for term_id, term in enumerate(terms):
+        if len(term) <= k * d + d:
+            for variant in deletions(term, d):
+                keys.append(deletion_key(variant))
+                ids.append(term_id)
+    keys = np.array(keys, dtype=np.uint64)
+    order = np.argsort(keys, kind='stable')
+    return keys[order], np.array(ids, dtype=np.int32)[order]
+
+
+def build_kgram(terms, k=KGRAM, d=FUZZY_DIST):
+    # gram -> sorted ids into the sorted term list for grams of MIN_GRAM to k characters,
+    # plus the deletion variants of the short terms
+    grams = dict()
+    for term_id, term in enumerate(terms):
+        for n in range(MIN_GRAM, k + 1):
+            for gram in term_grams(term, n):
+                grams.setdefault(gram, []).append(term_id)
+    keys = sorted(grams)
+    indptr = np.cumsum([0] + [len(grams[gram]) for gram in keys])
+    ids = np.array([term_id for gram in keys for term_id in grams[gram]], dtype=np.int32)
+    del_keys, del_ids = build_deletions(terms, k, d)
+    return {'k': k, 'min_gram': MIN_GRAM, 'terms': list(terms), 'gram_id': {gram: n for n, gram in enumerate(keys)}, 'indptr': indptr, 'ids': ids,
+            'length': np.array([len(term) for term in terms], dtype=np.int32),
+            'dist': d, 'del_keys': del_keys, 'del_ids': del_ids}
+
+
+def save_kgram(name, kgram):
+    with open(name + '.tmp', 'wb') as f:
+        np.savez(f, k=np.int64(kgram['k']), min_gram=np.int64(kgram['min_gram']), terms=np.array(kgram['terms'], dtype=str),
+                 grams=np.array(sorted(kgram['gram_id'], key=kgram['gram_id'].get), dtype=str),
+                 indptr=kgram['indptr'], ids=kgram['ids'],
+                 dist=np.int64(kgram['dist']), del_keys=kgram['del_keys'], del_ids=kgram['del_ids'])
+    os.replace(name + '.tmp', name)
+
+
+def load_kgram(name):
+    # built from dictionary.txt when the index file is missing, rebuilt from its terms when
+    # it was written before the shorter grams and deletion variants were stored
+    if not os.path.exists(name):
+        terms = []
+        with open('dictionary.txt', 'r') as f:
+            for line in f.readlines()[1:]:
+                terms.append(line.split()[1])
+        kgram = build_kgram(sorted(terms))
+        save_kgram(name, kgram)
+        return kgram
+    with np.load(name) as data:
+        terms = data['terms'].tolist()
+        if 'min_gram' not in data.files:
+            kgram = build_kgram(terms, int(data['k']))
+            save_kgram(name, kgram)
+            return kgram
+        kgram = {'k': int(data['k']), 'min_gram': int(data['min_gram']), 'terms': terms,
+                 'gram_id': {gram: n for n, gram in enumerate(data['grams'].tolist())},
+                 'indptr': data['indptr'], 'ids': data['ids'],
+                 'length': np.array([len(term) for term in terms], dtype=np.int32),
+                 'dist': int(data['dist']), 'del_keys': data['del_keys'], 'del_ids': data['del_ids']}
+        return kgram
+
+
+def gram_postings(kgram, gram):
+    n = kgram['gram_id'].get(gram)
+    if n is None:
+        return np.zeros(0, dtype=np.int32)
+    return kgram['ids'][kgram['indptr'][n]:kgram['indptr'][n + 1]]
+
+
+def wildcard(kgram, pattern):
+    # intersect the posting lists of the grams around the *, shortest list first,
+    # then check the few candidates left against the pattern itself. A piece shorter
+    # than k (the s$ of *s, the ab of *ab*) is a gram of its own length
+    k = kgram['k']
+    padded = '$' + pattern + '$'
+    grams = set()
+    for piece in padded.split('*'):
+        if len(piece) >= k:
+            grams.update(piece[n:n + k] for n in range(len(piece) - k + 1))
+        elif len(piece) >= kgram['min_gram']:
+            grams.add(piece)
+    lists = sorted((gram_postings(kgram, gram) for gram in grams), key=len)
+    if lists:
+        candidates = lists[0]
+        for plist in lists[1:]:
+            if not len(candidates):
+                break
+            candidates = np.intersect1d(candidates, plist, assume_unique=True)
+    else:
+        # only single letters between the * (*a*b*), they match most of the terms anyway
+        candidates = range(len(kgram['terms']))
+    regex = re.compile('.*'.join(re.escape(piece) for piece in pattern.split('*')) + r'\Z')
+    return [kgram['terms'][n] for n in candidates if regex.match(kgram['terms'][n])]
+
+
+def edit_distance(term, others):
+    # Levenshtein distance from term to every candidate in one dynamic program, a numpy
+    # column per position; candidates are padded, a cell only depends on columns to its left
+    width = max(len(other) for other in others)
+    chars = np.array(others, dtype=f'<U{width}').view('<U1').reshape(len(others), width)
+    prev = np.tile(np.arange(width + 1), (len(others), 1))
+    for i, ch in enumerate(term, 1):
+        best = np.minimum(prev[:, :-1] + (chars != ch), prev[:, 1:] + 1)
+        cur = np.empty_like(prev)
+        cur[:, 0] = i
+        for j in range(1, width + 1):
+            cur[:, j] = np.minimum(best[:, j - 1], cur[:, j - 1] + 1)
+        prev = cur
+    return prev[np.arange(len(others)), [len(other) for other in others]]
+
+
+def deletion_candidates(kgram, term, max_dist):
+    # terms sharing one of the query's deletion variants, looked up in the sorted keys
+    keys = np.array(sorted(deletion_key(variant) for variant in deletions(term, max_dist)), dtype=np.uint64)
+    start = np.searchsorted(kgram['del_keys'], keys, 'left')
+    end = np.searchsorted(kgram['del_keys'], keys, 'right')
+    return np.unique(np.concatenate([kgram['del_ids'][s:e] for s, e in zip(start, end)]))
+
+
+def fuzzy(kgram, term, max_dist=FUZZY_DIST):
+    # one edit changes at most k grams, so a match within max_dist shares at least
+    # |grams| - k * max_dist of them; only those terms get an edit distance.
+    # short queries, where that bound is 0, go through the deletion variants instead
+    k = kgram['k']
+    grams = term_grams(term, k)
+    need = len(grams) - k * max_dist
+    close = np.abs(kgram['length'] - len(term)) <= max_dist
+    if need > 0:
+        hits = np.bincount(np.concatenate([gram_postings(kgram, gram) for gram in grams]), minlength=len(kgram['terms']))
+        candidates = np.flatnonzero((hits >= need) & close)
+    elif max_dist <= kgram['dist'] and len(term) + max_dist <= k * kgram['dist'] + kgram['dist']:
+        candidates = deletion_candidates(kgram, term, max_dist)
+        candidates = candidates[close[candidates]]
+    else:
+        candidates = np.flatnonzero(close)
+    if not len(candidates):
+        return []
+    others = [kgram['terms'][n] for n in candidates]
+    dist = edit_distance(term, others)
+    return sorted((int(d), other) for d, other in zip(dist, others) if d <= max_dist)
+
+
 def cos_similarity(doc1, doc2):
-    result = 1 - spatial.distance.cosine(doc1, doc2)
+    # sparse term id -> tf-idf dicts
+    dot = sum(weight * doc2.get(term_id, 0) for term_id, weight in doc1.items())
+    norm = math.sqrt(sum(w * w for w in doc1.values()) * sum(w * w for w in doc2.values()))
+    result = dot / norm if norm else 0.0
     print(result)
     return result
 
@@ -435,6 +1515,108 @@ def asending(elem):
 
 
 if __name__ == '__main__':
-    main()
+    # python Tf-idf_Vectors.py                   rebuild dictionary.txt and vector/ from scratch
+    # python Tf-idf_Vectors.py add [id ...]      index documents into a new segment of index/,
+    #                                            no id adds every corpus document not indexed yet
+    # python Tf-idf_Vectors.py remove <id ...>   delete documents from index/
+    # python Tf-idf_Vectors.py merge [--all]     merge small segments (--all: into one)
+    # python Tf-idf_Vectors.py vector <id>       tf-idf of one indexed document
+    # python Tf-idf_Vectors.py export            write dictionary.txt, vector/ and kgram.npz from index/
+    # python Tf-idf_Vectors.py neighbors <id> [k] the k documents most similar to a document
+    # python Tf-idf_Vectors.py knn [k]           store every document's k neighbors in knn.npz
+    # python Tf-idf_Vectors.py duplicates [threshold] [--verify]
+    #                                            near duplicate pairs by minhash / lsh,
+    #                                            --verify checks them with cosine on vector/
+    # python Tf-idf_Vectors.py lsi [k]           reduce vector/ to k dimensions into lsi.npz
+    # python Tf-idf_Vectors.py lsi_report [k]    timing and quality of lsi against full tf-idf
+    # python Tf-idf_Vectors.py lsi_query <text>  rank documents for a query folded into lsi.npz
+    # neighbors <id> [k] --lsi                   neighbors on the lsi vectors
+    # python Tf-idf_Vectors.py hash [bits]       hashed tf vectors of the corpus into hashed.npz
+    # neighbors <id> [k] --hashed                neighbors on the hashed vectors
+    # python Tf-idf_Vectors.py quantize [float16|int8]  store vector/ quantized in vector.q
+    # python Tf-idf_Vectors.py quantize_report   cosine and neighbor changes of both modes
+    # python Tf-idf_Vectors.py --positional      also write the positional index positional.idx
+    # python Tf-idf_Vectors.py phrase <words>    documents containing the phrase, with its positions
+    # python Tf-idf_Vectors.py near <k> <words>  documents with all the words within k words
+    # python Tf-idf_Vectors.py wildcard <pattern> dictionary terms matching a pattern with *
+    # python Tf-idf_Vectors.py fuzzy <term> [d]  dictionary terms within edit distance d
+    if len(sys.argv) > 1 and sys.argv[1] == 'add':
+        doc_ids = [int(val) for val in sys.argv[2:]]
+        if not doc_ids:
+            indexed = live_docs(load_manifest(INDEX_PATH))
+            doc_ids = [i for i in range(1, open_corpus(CORPUS)['count'] + 1) if i not in indexed]
+        add_documents(INDEX_PATH, doc_ids)
+    elif len(sys.argv) > 2 and sys.argv[1] == 'remove':
+        remove_documents(INDEX_PATH, [int(val) for val in sys.argv[2:]])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'merge':
+        merge_segments(INDEX_PATH, '--all' in sys.argv)
+    elif len(sys.argv) > 2 and sys.argv[1] == 'vector':
+        print_vector(INDEX_PATH, int(sys.argv[2]))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'export':
+        export_index(INDEX_PATH)
+    elif len(sys.argv) > 2 and sys.argv[1] == 'neighbors' and '--lsi' in sys.argv:
+        args = [val for val in sys.argv[2:] if val != '--lsi']
+        lsi = load_lsi(LSI_FILE)
+        for n, score in lsi_neighbors(unit_rows(lsi['docs']), lsi['doc_ids'], int(args[0]), int(args[1]) if len(args) > 1 else NEIGHBORS):
+            print(n, score)
+    elif len(sys.argv) > 2 and sys.argv[1] == 'neighbors' and '--hashed' in sys.argv:
+        args = [val for val in sys.argv[2:] if val != '--hashed']
+        X = read_hashed(HASH_FILE)
+        # hashed rows are the corpus documents in order
+        for n, score in neighbors(X, X.tocsc(), np.arange(1, X.shape[0] + 1), int(args[0]), int(args[1]) if len(args) > 1 else NEIGHBORS):
+            print(n, score)
+    elif len(sys.argv) > 2 and sys.argv[1] == 'neighbors':
+        more_like_this(int(sys.argv[2]), int(sys.argv[3]) if len(sys.argv) > 3 else NEIGHBORS)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'knn':
+        doc_ids, X = read_vectors(VECTOR_PATH)
+        ids, sims = knn_graph(X, doc_ids, int(sys.argv[2]) if len(sys.argv) > 2 else NEIGHBORS)
+        save_knn(KNN_FILE, ids, sims, X, doc_ids)
+        print(f'saved {ids.shape[1]} neighbors of {X.shape[0]} documents to {KNN_FILE}')
+    elif len(sys.argv) > 1 and sys.argv[1] == 'duplicates':
+        args = [val for val in sys.argv[2:] if val != '--verify']
+        near_duplicates(float(args[0]) if args else DUP_THRESHOLD, '--verify' in sys.argv)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'lsi':
+        doc_ids, X = read_vectors(VECTOR_PATH)
+        lsi = build_lsi(X, int(sys.argv[2]) if len(sys.argv) > 2 else LSI_DIM)
+        lsi['doc_ids'] = doc_ids
+        save_lsi(LSI_FILE, lsi)
+        print(f'saved {lsi["docs"].shape[1]} dimensional vectors of {lsi["docs"].shape[0]} documents to {LSI_FILE}')
+    elif len(sys.argv) > 1 and sys.argv[1] == 'lsi_report':
+        lsi_report(int(sys.argv[2]) if len(sys.argv) > 2 else LSI_DIM)
+    elif len(sys.argv) > 2 and sys.argv[1] == 'lsi_query':
+        lsi_query(' '.join(sys.argv[2:]), NEIGHBORS)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'hash':
+        X = hash_vectors(int(sys.argv[2]) if len(sys.argv) > 2 else HASH_BITS, os.cpu_count() or 1)
+        sparse.save_npz(HASH_FILE, X)
+        print(f'saved {X.shape[0]} documents x {X.shape[1]} hashed features to {HASH_FILE}')
+    elif len(sys.argv) > 1 and sys.argv[1] == 'quantize':
+        mode = sys.argv[2] if len(sys.argv) > 2 else 'float16'
+        doc_ids, X = read_vectors(VECTOR_PATH)
+        q = quantize_vectors(X, mode)
+        save_quantized(QUANT_FILE, q, doc_ids)
+        print(f'saved {q["shape"][0]} {mode} vectors to {QUANT_FILE}, {os.path.getsize(QUANT_FILE)} bytes')
+    elif len(sys.argv) > 1 and sys.argv[1] == 'quantize_report':
+        quantize_report()
+    elif len(sys.argv) > 2 and sys.argv[1] == 'phrase':
+        for doc_id, starts in phrase_query(load_positional(POSITIONAL_FILE), ' '.join(sys.argv[2:])):
+            print(doc_id, *starts)
+    elif len(sys.argv) > 3 and sys.argv[1] == 'near':
+        for doc_id, span in proximity_query(load_positional(POSITIONAL_FILE), ' '.join(sys.argv[3:]), int(sys.argv[2])):
+            print(doc_id, span)
+    elif len(sys.argv) > 2 and sys.argv[1] == 'wildcard':
+        for term in wildcard(load_kgram(KGRAM_FILE), sys.argv[2].lower()):
+            print(term)
+    elif len(sys.argv) > 2 and sys.argv[1] == 'fuzzy':
+        for dist, term in fuzzy(load_kgram(KGRAM_FILE), sys.argv[2].lower(), int(sys.argv[3]) if len(sys.argv) > 3 else FUZZY_DIST):
+            print(term, dist)
+    elif len(sys.argv) > 1 and sys.argv[1].startswith('--'):
+        # python Tf-idf_Vectors.py [--min-df n|share] [--max-df n|share] [--max-features n] [--positional]
+        options = {'--min-df': MIN_DF, '--max-df': MAX_DF, '--max-features': MAX_FEATURES}
+        args = [val for val in sys.argv[1:] if val != '--positional']
+        for n in range(0, len(args) - 1, 2):
+            options[args[n]] = float(args[n + 1]) if '.' in args[n + 1] else int(args[n + 1])
+        main(options['--min-df'], options['--max-df'], int(options['--max-features']), '--positional' in sys.argv)
+    else:
+        main()
 
     
\ No newline at end of file